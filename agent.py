@@ -1,33 +1,73 @@
 from dataclasses import dataclass
 import abc
 from enum import Enum
-from typing import Callable, Optional, Coroutine, Dict, Union
+from typing import Callable, Optional, Coroutine, Dict, Union, AsyncIterator, AsyncContextManager, TYPE_CHECKING
+from collections import Counter
 import uuid
-from threading import Thread, Lock
+import itertools
+from threading import Thread
+from contextlib import nullcontext
 import asyncio
-from speech_provider import SpeechProvider
+import logging
+import time
+from speech_provider import SpeechProvider, SpeechChunker
+from instrumentation import instrumentation
+from response_cache import ResponseCache
+
+if TYPE_CHECKING:
+    from context_window import ContextWindow
+    from session_store import SessionStore
+
+
+logger = logging.getLogger(__name__)
+
+# ids only have to be unique within a process, the guid is what leaves it
+_context_ids = itertools.count()
 
 
 class AgentContext:
-    guid: str
+    __slots__ = ('id', 'value', 'token_count', '_guid')
+    id: int
     value: str
+    token_count: int | None
 
     def __init__(self, value: str):
-        self.guid = str(uuid.uuid4())
+        self.id = next(_context_ids)
         self.value = value
+        self.token_count = None
+        self._guid = None
+
+    @property
+    def guid(self) -> str:
+        """A UUID string for the entry, generated the first time something needs to serialize it."""
+        if self._guid is None:
+            self._guid = str(uuid.uuid4())
+        return self._guid
+
+    @guid.setter
+    def guid(self, guid: str):
+        self._guid = guid
 
 
 class EnvironmentalContext(AgentContext):
-    pass
+    __slots__ = ('urgent',)
+    # urgent context pre-empts whatever the agent is doing, it isn't kept when the session is stored
+    urgent: bool
+
+    def __init__(self, value: str, urgent: bool = False):
+        super().__init__(value)
+        self.urgent = urgent
 
 
 class HumanContext(AgentContext):
-    pass
+    __slots__ = ()
 
 
 class ToolCallContext(AgentContext):
+    __slots__ = ('parameters', 'response_id')
     parameters: dict[str, ...]
-    response_id: str | None
+    # the id of the response to this call, None while the call is still running
+    response_id: int | None
 
     def __init__(self, value: str, parameters: dict[str, ...]):
         super().__init__(value)
@@ -36,6 +76,7 @@ class ToolCallContext(AgentContext):
 
 
 class ToolCallResponseContext(AgentContext):
+    __slots__ = ('call_id',)
     call_id: str
 
     def __init__(self, value: str, call_id: str):
@@ -44,11 +85,16 @@ class ToolCallResponseContext(AgentContext):
 
 
 class AgentResponseContext(AgentContext):
-    pass
+    __slots__ = ()
 
 
 class SystemPromptContext(AgentContext):
-    pass
+    __slots__ = ()
+
+
+class SummaryContext(AgentContext):
+    """A compact summary of older context that has been evicted to stay within the token budget."""
+    __slots__ = ()
 
 
 class FinishReason(Enum):
@@ -56,6 +102,24 @@ class FinishReason(Enum):
     TOOL_CALL = 1
 
 
+class ForcedActionFallback(Enum):
+    # add a call to the forced action with no parameters to the last response
+    SYNTHESIZE = 0
+    # raise ForcedActionNotUsedError
+    FAIL = 1
+
+
+class ForcedActionNotUsedError(Exception):
+    """Raised when an agent keeps responding without calling a forced action."""
+    action_name: str
+    attempts: int
+
+    def __init__(self, action_name: str, attempts: int):
+        super().__init__(f'response did not call forced action {action_name} after {attempts} attempts')
+        self.action_name = action_name
+        self.attempts = attempts
+
+
 @dataclass
 class AgentResponse:
     text_response: str
@@ -64,12 +128,32 @@ class AgentResponse:
 
 ActionFunction = Callable[[Dict[str, ...]], Union[str, Coroutine[str, None, str]]]
 
+
+class ActionFailure(str):
+    """A result an action returns when it couldn't run, such as when whatever runs it is unavailable. It is told
+    to the model like any other result, but never cached, so the call is tried again next time."""
+
+
 @dataclass
 class Action:
     name: str
     description: str
     parameter_schema: object
     func: ActionFunction
+    # how many calls of this action may run at once, None for no limit
+    max_concurrency: Optional[int] = None
+    # seconds a call may take before it is abandoned, None to wait forever
+    timeout: Optional[float] = None
+    # calls with the same parameters always give the same result, so results can be reused from the result cache
+    idempotent: bool = False
+
+
+@dataclass(frozen=True)
+class ActionRegistrySnapshot:
+    """Every action available at one version of an ActionManager, registered actions first and then ephemeral
+    ones. Anything derived from a snapshot can be reused for as long as the version doesn't change."""
+    version: int
+    actions: tuple[Action, ...]
 
 
 class ActionManager:
@@ -77,61 +161,102 @@ class ActionManager:
     lifetime_ephemeral_group_count: int
     actions: dict[str, Action]
     ephemeral_groups: dict[int, list[Action]]
-    forced_actions_queue: list[str]
+    # used as an ordered set, the values are always None
+    forced_actions_queue: dict[str, None]
+    # increases every time an action is registered, unregistered or an ephemeral group comes or goes
+    version: int
 
-    action_mutex: Lock
+    action_mutex: asyncio.Lock
+    # results of idempotent actions by action name and parameters, None to always run them
+    result_cache: ResponseCache | None
 
     def __init__(self):
         self.lifetime_ephemeral_group_count = 0
         self.actions = {}
         self.ephemeral_groups: dict[int, list[Action]] = {}
-        self.forced_actions_queue = []
-        self.action_mutex = Lock()
+        # action name -> the ephemeral group it is in and the action, for the oldest group with an action of that name
+        self._ephemeral_index: dict[str, tuple[int, Action]] = {}
+        self.forced_actions_queue = {}
+        self.version = 0
+        self._snapshot: ActionRegistrySnapshot | None = None
+        # only guards the registry and ephemeral group lookups, actions themselves run outside of it
+        self.action_mutex = asyncio.Lock()
+        # action name -> the max_concurrency the semaphore was made for and the semaphore, kept when the action is
+        # registered again so calls still running are counted against the same limit
+        self._action_semaphores: dict[str, tuple[int, asyncio.Semaphore]] = {}
+        self.result_cache = None
 
     async def preform_action(self, call: ToolCallContext) -> ToolCallResponseContext:
-        """Called only by agents. Will execute a function of a given name."""
-        self.action_mutex.acquire()
-        if call.value in self.actions:
-            action = self.actions[call.value]
-        else:
-            ephemeral = self._find_action_name_in_ephemeral_group(call.value)
-            if ephemeral is None:
-                res_ctx = ToolCallResponseContext("action not recognised, try a different function name", call.guid)
-                call.response_id = res_ctx.guid
-                self.action_mutex.release()
-                return res_ctx
+        """Called only by agents. Will execute a function of a given name. The call's response_id is left for
+        whoever adds the response to the context to set, it marks the response as being there."""
+        async with self.action_mutex:
+            action = self._take_action(call.value)
 
-            ephemeral_group_id, action = ephemeral
-            del self.ephemeral_groups[ephemeral_group_id]
+        if action is None:
+            return ToolCallResponseContext("action not recognised, try a different function name", call.guid)
 
-        if action.name in self.forced_actions_queue:
-            self.forced_actions_queue.remove(action.name)
+        cache_key = None
+        if action.idempotent and self.result_cache is not None:
+            cache_key = self.result_cache.key({'action': action.name, 'parameters': call.parameters})
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                return ToolCallResponseContext(cached, call.guid)
 
         try:
-            resp = action.func(call.parameters)
-
-            if asyncio.iscoroutine(resp):
-                resp = await resp
+            async with self._get_action_semaphore(action):
+                with instrumentation.span('tool_call', action.name):
+                    resp = action.func(call.parameters)
+
+                    if asyncio.iscoroutine(resp):
+                        resp = await asyncio.wait_for(resp, action.timeout)
+        except asyncio.TimeoutError:
+            res_ctx = ToolCallResponseContext(f"The action timed out after {action.timeout} seconds. Tell the user.",
+                                              call.guid)
+            logger.warning('action %s timed out after %s seconds', action.name, action.timeout)
+            return res_ctx
         except Exception as error:
             res_ctx = ToolCallResponseContext(f"An error occurred {str(error)}. Tell the user.", call.guid)
-            print("AN ERROR IS HAPPENING ALSKDLADSLALJDNAS")
-            print('an error occurred:', error)
-            call.response_id = res_ctx.guid
-            self.action_mutex.release()
+            logger.warning('action %s raised %r', action.name, error)
             return res_ctx
 
-        res_ctx = ToolCallResponseContext(resp, call.guid)
-        call.response_id = res_ctx.guid
-        self.action_mutex.release()
-        return res_ctx
+        # only results are cached, a call that failed or timed out is tried again next time
+        if cache_key is not None and not isinstance(resp, ActionFailure):
+            self.result_cache.put(cache_key, resp)
+
+        return ToolCallResponseContext(resp, call.guid)
+
+    def _take_action(self, name: str) -> Action | None:
+        """Looks up the action for a call. Using an ephemeral action removes its group, and using a forced action
+        takes it off the queue. Must be called while holding the action mutex."""
+        if name in self.actions:
+            action = self.actions[name]
+        else:
+            ephemeral = self._find_action_name_in_ephemeral_group(name)
+            if ephemeral is None:
+                return None
+
+            ephemeral_group_id, action = ephemeral
+            self.remove_ephemeral_action_group(ephemeral_group_id)
+
+        self.forced_actions_queue.pop(action.name, None)
+
+        return action
+
+    def _get_action_semaphore(self, action: Action) -> asyncio.Semaphore | nullcontext:
+        if action.max_concurrency is None:
+            return nullcontext()
+
+        limit, semaphore = self._action_semaphores.get(action.name, (None, None))
+        if limit != action.max_concurrency:
+            semaphore = asyncio.Semaphore(action.max_concurrency)
+            self._action_semaphores[action.name] = (action.max_concurrency, semaphore)
+
+        return semaphore
 
     def _find_action_name_in_ephemeral_group(self, name: str) -> (int, Action) or None:
         """finds an action inside the ephemeral groups, if found returns its ephemeral group id and the associated
         action. Otherwise, returns None"""
-        for idx, group in self.ephemeral_groups.items():
-            for action in group:
-                if action.name == name:
-                    return idx, action
+        return self._ephemeral_index.get(name)
 
     def response_meets_action_criteria(self, response: AgentResponse):
         """Called only by agents. Will return whether a response uses any forced actions or any other future added
@@ -139,31 +264,76 @@ class ActionManager:
         if len(self.forced_actions_queue) == 0:
             return True
 
-        names = [call.value for call in response.tool_calls]
+        if response.tool_calls is None:
+            return False
+
+        return any(call.value in self.forced_actions_queue for call in response.tool_calls)
+
+    def next_forced_action(self) -> str | None:
+        """Returns the name of the forced action that has waited longest, or None if there isn't one."""
+        return next(iter(self.forced_actions_queue), None)
 
-        return any([name in self.forced_actions_queue for name in names])
+    def snapshot(self) -> ActionRegistrySnapshot:
+        """Returns every available action. The snapshot is only rebuilt when the version has changed."""
+        if self._snapshot is None or self._snapshot.version != self.version:
+            actions = list(self.actions.values())
+            for group in self.ephemeral_groups.values():
+                actions.extend(group)
+            self._snapshot = ActionRegistrySnapshot(self.version, tuple(actions))
 
+        return self._snapshot
+
+    def _notify_action_changed(self):
+        self.version += 1
 
     def register_action(self, action: Action):
         """Adds the action to the internal registered actions dictionary."""
-        print(f'registering action {action.name}')
+        logger.debug('registering action %s', action.name)
         self.actions[action.name] = action
+        self._notify_action_changed()
 
     def unregister_action(self, name: str):
         """Removes the action of the given name from the internal registered actions dictionary."""
         del self.actions[name]
+        self.forced_actions_queue.pop(name, None)
+        self._notify_action_changed()
 
     def enqueue_forced_action(self, name: str):
         """Will force the action of the given name to be run before the next response."""
-        if name not in self.forced_actions_queue:
-            self.forced_actions_queue.append(name)
+        self.forced_actions_queue.setdefault(name, None)
 
     def create_ephemeral_action_group(self, actions: list[Action]) -> int:
         """Returns an ephemeral group ID. An ephemeral group is removed once one is used. Good for making a decision."""
-        self.ephemeral_groups[self.lifetime_ephemeral_group_count] = actions
+        group_id = self.lifetime_ephemeral_group_count
+        self.ephemeral_groups[group_id] = actions
         self.lifetime_ephemeral_group_count += 1
 
-        return self.lifetime_ephemeral_group_count
+        for action in actions:
+            self._ephemeral_index.setdefault(action.name, (group_id, action))
+
+        self._notify_action_changed()
+
+        return group_id
+
+    def remove_ephemeral_action_group(self, group_id: int):
+        """Removes an ephemeral group that hasn't been used, does nothing if it already has been."""
+        group = self.ephemeral_groups.pop(group_id, None)
+        if group is None:
+            return
+
+        for action in group:
+            if self._ephemeral_index.get(action.name, (None,))[0] != group_id:
+                continue
+            del self._ephemeral_index[action.name]
+
+            # another group may have an action of the same name, which the index should point at now
+            for other_id, other_group in self.ephemeral_groups.items():
+                other = next((candidate for candidate in other_group if candidate.name == action.name), None)
+                if other is not None:
+                    self._ephemeral_index[action.name] = (other_id, other)
+                    break
+
+        self._notify_action_changed()
 
 
 class Agent(metaclass=abc.ABCMeta):
@@ -171,22 +341,268 @@ class Agent(metaclass=abc.ABCMeta):
         self._speech_provider = speech_provider
         self.action_manager = ActionManager()
         self._ctx: list[AgentContext] = []
+        # context id -> position in _ctx, only trusted below _positions_valid_to since inserts shift what follows
+        self._positions: dict[int, int] = {}
+        self._positions_valid_to = 0
+        # tool call guid -> context id, so a late response can find its call without a scan
+        self._tool_call_ids: dict[str, int] = {}
         self.context_added_notifiers: list[Callable[[AgentContext], ...]] = []
+        # goes up whenever context is added, so a response generated earlier can tell if it is still current
+        self.context_version = 0
+        # resolves once the most recently queued speech has been heard
+        self._speech_finished: asyncio.Future | None = None
+        # when set, old context is evicted (and optionally summarized) to stay within its token budget
+        self.context_window: Optional["ContextWindow"] = None
+        # when set, every change to the context is logged to it so the session can be resumed after a restart
+        self.session_store: Optional["SessionStore"] = None
+        self._context_over_budget = False
+        # how many times a response is generated when it doesn't call a forced action, before falling back
+        self.max_forced_action_attempts = 3
+        self.forced_action_fallback = ForcedActionFallback.SYNTHESIZE
+        # how many responses needed each number of regenerations, and how many the last response needed
+        self.regeneration_counts: Counter[int] = Counter()
+        self.last_regeneration_count = 0
+        # entered around every model request and around synthesizing each piece of speech, so agents sharing a
+        # client or a synthesizer can take turns on it
+        self.request_slot: Callable[[], AsyncContextManager] = nullcontext
+        self.speech_slot: Callable[[], AsyncContextManager] = nullcontext
 
     def add_context(self, agent_context: AgentContext):
-        if isinstance(agent_context, ToolCallResponseContext) and not isinstance(self._ctx[len(self._ctx) - 1], ToolCallContext):
-            recent = self.find_recent_response()
-            self._ctx.insert(self._ctx.index(recent) + 1, agent_context)
-        else:
-            self._ctx.append(agent_context)
+        position = len(self._ctx)
+        if type(agent_context) is ToolCallResponseContext:
+            # responses go with their call, which is not always the last thing in the context when calls are async
+            position = self._find_call_response_position(agent_context.call_id)
+        self._ctx.insert(position, agent_context)
+        self.context_version += 1
+
+        self._index_context(position, agent_context)
+        self._context_inserted(position, agent_context)
+
+        if self.session_store is not None:
+            self.session_store.append(position, agent_context, self._ctx)
+
+        if self.context_window is not None and self.context_window.added(agent_context):
+            self._context_over_budget = True
 
         for notifier in self.context_added_notifiers:
             notifier(agent_context)
 
+    def _index_context(self, position: int, agent_context: AgentContext):
+        if self._positions_valid_to == position:
+            self._positions_valid_to += 1
+        else:
+            # everything after an insert has moved along one, those positions are fixed up the next time one is needed
+            self._positions_valid_to = min(self._positions_valid_to, position + 1)
+        self._positions[agent_context.id] = position
+
+        if type(agent_context) is ToolCallContext:
+            self._tool_call_ids[agent_context.guid] = agent_context.id
+
+    def _rebuild_index(self):
+        self._positions = {entry.id: position for position, entry in enumerate(self._ctx)}
+        self._positions_valid_to = len(self._ctx)
+        self._tool_call_ids = {entry.guid: entry.id for entry in self._ctx if type(entry) is ToolCallContext}
+
+    def _position_of(self, context_id: int) -> int | None:
+        if self._positions_valid_to < len(self._ctx):
+            for position in range(self._positions_valid_to, len(self._ctx)):
+                self._positions[self._ctx[position].id] = position
+            self._positions_valid_to = len(self._ctx)
+
+        return self._positions.get(context_id)
+
+    def _find_call_response_position(self, call_id: str) -> int:
+        """Finds where a late tool call response belongs, which is after the other calls and responses of the
+        response that made the call."""
+        position = None
+        call_context_id = self._tool_call_ids.get(call_id)
+        if call_context_id is not None:
+            position = self._position_of(call_context_id)
+
+        if position is None:
+            recent = self.find_recent_response()
+            position = self._ctx.index(recent)
+
+        position += 1
+        while position < len(self._ctx) and type(self._ctx[position]) in (ToolCallContext, ToolCallResponseContext):
+            position += 1
+
+        return position
+
+    def restore_context(self, session_store: "SessionStore"):
+        """Replaces the context with the one logged to the session store, and keeps logging to it."""
+        self._ctx = session_store.load()
+        self.session_store = session_store
+        self.context_version += 1
+
+        responses = {entry.call_id: entry for entry in self._ctx if type(entry) is ToolCallResponseContext}
+        for entry in self._ctx:
+            if type(entry) is not ToolCallContext:
+                continue
+            response = responses.get(entry.guid)
+            if response is not None:
+                entry.response_id = response.id
+
+        self._rebuild_index()
+        self._context_reset()
+        self._context_over_budget = self.context_window is not None
+
+        # calls that were running when the agent stopped will never get their result
+        for entry in list(self._ctx):
+            if type(entry) is ToolCallContext and entry.response_id is None:
+                response = ToolCallResponseContext("the result of this action was lost when the agent restarted.",
+                                                   entry.guid)
+                entry.response_id = response.id
+                self.add_context(response)
+
+    def _record_regenerations(self, count: int):
+        self.last_regeneration_count = count
+        self.regeneration_counts[count] += 1
+
+    def _forced_action_fallback(self, response: AgentResponse) -> AgentResponse:
+        """Called once a response still hasn't called a forced action after every attempt."""
+        name = self.action_manager.next_forced_action()
+        if self.forced_action_fallback == ForcedActionFallback.FAIL:
+            raise ForcedActionNotUsedError(name, self.max_forced_action_attempts)
+
+        logger.warning('agent never called forced action %s, calling it without parameters', name)
+        tool_calls = (response.tool_calls or []) + [ToolCallContext(name, {})]
+        return AgentResponse(response.text_response, tool_calls, FinishReason.TOOL_CALL)
+
+    async def fit_context_window(self):
+        """Evicts old context until it fits the context window's token budget. Agents call this before building a
+        request, summarizing can take a request of its own so it isn't done while context is being added."""
+        if not self._context_over_budget:
+            return
+        self._context_over_budget = False
+
+        before = list(self._ctx)
+        fitted = await self.context_window.fit(before)
+        if fitted is None:
+            return
+
+        # context keeps being added while the summary is requested, so the live list is changed rather than replaced
+        # with the fitted copy, which would drop anything added in the meantime
+        kept_ids = {entry.id for entry in fitted}
+        evicted_ids = {entry.id for entry in before if entry.id not in kept_ids}
+        before_ids = {entry.id for entry in before}
+        added = [entry for entry in fitted if entry.id not in before_ids]
+
+        ctx = [entry for entry in self._ctx if entry.id not in evicted_ids]
+        position = 0
+        while position < len(ctx) and type(ctx[position]) is SystemPromptContext:
+            position += 1
+        ctx[position:position] = added
+
+        logger.info('context window evicted %d entries', len(evicted_ids))
+        self._ctx = ctx
+        self.context_window.total_tokens = sum(self.context_window.count_tokens(entry) for entry in ctx)
+        self._rebuild_index()
+        self._context_reset()
+
+        if self.session_store is not None:
+            self.session_store.snapshot(self._ctx)
+
+    def _context_inserted(self, position: int, agent_context: AgentContext):
+        """Called after an entry has been put into the context at the given position. Agents that keep their own
+        representation of the context update it from here."""
+        pass
+
+    def _context_reset(self):
+        """Called after the context has been replaced as a whole, such as when old entries are evicted."""
+        pass
+
     @abc.abstractmethod
-    def generate_response(self) -> (AgentResponse, str):
+    async def generate_response(self, pending: list[AgentContext] | None = None) -> AgentResponse:
+        """Generates a response to the context. pending is context the response should see as if it came after
+        everything else, without adding it, such as a transcript the user hasn't finished yet."""
         pass
 
+    async def generate_response_stream(self, pending: list[AgentContext] | None = None) \
+            -> AsyncIterator[Union[str, AgentResponse]]:
+        """Yields text deltas as the response is generated, then the finished AgentResponse as the last item. Agents
+        that can't stream yield their whole text at once."""
+        response = await self.generate_response(pending)
+        if response.text_response:
+            yield response.text_response
+        yield response
+
+    async def generate_and_speak_response(self) -> AgentResponse:
+        """Generates a response while speaking it, so the first sentence plays while the rest is still generating.
+        Returns once everything has been handed to the speech provider, use wait_for_speech to wait until it has
+        been heard."""
+        chunker = SpeechChunker()
+        chunks: asyncio.Queue[str | None] = asyncio.Queue()
+        # speaking happens on its own task so synthesizing one chunk doesn't hold up reading the next deltas
+        speaker = asyncio.create_task(self._speak_chunks(chunks))
+        response = None
+
+        try:
+            async for item in self.generate_response_stream():
+                if isinstance(item, AgentResponse):
+                    response = item
+                    continue
+
+                for chunk in chunker.feed(item):
+                    chunks.put_nowait(chunk)
+
+            rest = chunker.flush()
+            if rest != '':
+                chunks.put_nowait(rest)
+        except asyncio.CancelledError:
+            # what hasn't been spoken yet goes with the cancelled response
+            speaker.cancel()
+            raise
+        finally:
+            chunks.put_nowait(None)
+
+        await speaker
+        return response
+
+    async def _speak_chunks(self, chunks: asyncio.Queue):
+        while (chunk := await chunks.get()) is not None:
+            await self._speak(chunk)
+
+    async def _speak(self, text: str):
+        async with self.speech_slot():
+            with instrumentation.span('tts_synthesis'):
+                speech = await self._speech_provider.speak(text)
+
+        # playback is timed from when the audio was queued until it has been heard. Waiting for speech waits on a
+        # future resolved after it is recorded, so the turn can't finish between the two.
+        queued = time.perf_counter()
+        heard = asyncio.get_running_loop().create_future()
+
+        def on_heard(future: asyncio.Future):
+            instrumentation.record('tts_playback', queued)
+            if future.cancelled():
+                heard.cancel()
+            elif future.exception() is not None:
+                heard.set_exception(future.exception())
+            else:
+                heard.set_result(future.result())
+
+        speech.add_done_callback(on_heard)
+        self._speech_finished = heard
+
+    async def wait_for_speech(self) -> bool:
+        """Waits until everything given to the speech provider has been heard. Returns False if it was cancelled."""
+        if self._speech_finished is None:
+            return True
+        return await self._speech_finished
+
+    def cancel_speech(self):
+        self._speech_provider.cancel_speech()
+
+    async def warm_up(self):
+        """Gets what the agent needs ready before its first response, without blocking. The speech provider warms
+        up separately."""
+        pass
+
+    @property
+    def speech_provider(self) -> SpeechProvider:
+        return self._speech_provider
+
     async def add_response_to_context(self, response: AgentResponse, execute_calls: bool = False,
                                 execute_calls_async: bool = False):
         self.add_context(AgentResponseContext(response.text_response))
@@ -200,24 +616,42 @@ class Agent(metaclass=abc.ABCMeta):
         if not execute_calls:
             return
 
-        for tool_call in response.tool_calls:
-            async def i_hate_internal_functions():
-                self.add_context(await self.action_manager.preform_action(tool_call))
-
-            if execute_calls_async:
-                asyncio.create_task(i_hate_internal_functions())
-            else:
-                await i_hate_internal_functions()
+        async def execute_all():
+            # the calls run concurrently, but their results go into the context in the order they were made
+            try:
+                results = await asyncio.gather(*[self.action_manager.preform_action(tool_call)
+                                                 for tool_call in response.tool_calls])
+            except asyncio.CancelledError:
+                self._add_cancelled_responses(response.tool_calls)
+                raise
+
+            for tool_call, result in zip(response.tool_calls, results):
+                tool_call.response_id = result.id
+                self.add_context(result)
+
+        if execute_calls_async:
+            asyncio.create_task(execute_all())
+        else:
+            await execute_all()
+
+    def _add_cancelled_responses(self, tool_calls: list[ToolCallContext]):
+        """Gives every call that didn't get its response into the context one saying it was cancelled, so the model
+        isn't left waiting on calls that will never finish."""
+        for tool_call in tool_calls:
+            if tool_call.response_id is not None and self._position_of(tool_call.response_id) is not None:
+                continue
+            res_ctx = ToolCallResponseContext("The action was cancelled, the user interrupted.", tool_call.guid)
+            tool_call.response_id = res_ctx.id
+            self.add_context(res_ctx)
 
     def find_recent_response(self):
         for entry in reversed(self._ctx):
             if isinstance(entry, AgentResponseContext):
                 return entry
 
-    def speak_recent_response(self):
+    async def speak_recent_response(self):
         res = self.find_recent_response()
-        if res.value == '':
+        if not res.value:
             return
-        print('speaking: ' + res.value)
-        self._speech_provider.generate_speech(res.value)
-        return
+        logger.info('speaking: %s', res.value)
+        await self._speak(res.value)
@@ -1,106 +1,269 @@
+import logging
+import time
 from abc import ABCMeta
-from typing import Iterable
+from typing import Iterable, AsyncIterator, Union
 from json import dumps, loads
-from openai import Client, NOT_GIVEN
+from openai import AsyncOpenAI, NOT_GIVEN
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionAssistantMessageParam, ChatCompletionToolParam
 
+from agents.openai_client import create_async_client, RetryPolicy, request_with_retries
+from instrumentation import instrumentation
+from response_cache import ResponseCache
 from agent import Agent, AgentResponse, HumanContext, EnvironmentalContext, ToolCallContext, AgentContext, \
-    ToolCallResponseContext, FinishReason, SystemPromptContext
+    ToolCallResponseContext, FinishReason, SystemPromptContext, AgentResponseContext, Action, \
+    SummaryContext
+
+logger = logging.getLogger(__name__)
 
 
 class OpenAiAgent(Agent, metaclass=ABCMeta):
-    def __init__(self, speech_provider):
+    def __init__(self, speech_provider, client: AsyncOpenAI | None = None, retry_policy: RetryPolicy | None = None):
         super().__init__(speech_provider)
-        self.client = Client()
-
-    def generate_response(self) -> AgentResponse:
-        messages: list[ChatCompletionMessageParam] = []
-
-        last_agent_ctx: ChatCompletionAssistantMessageParam | None = None
-
-        for entry in self._ctx:
-            if isinstance(entry, HumanContext):
-                messages.append({"role": "user", "content": entry.value})
-            elif isinstance(entry, EnvironmentalContext):
-                messages.append({"role": "system", "content": f"environmental context: {entry.value}"})
-            elif isinstance(entry, ToolCallContext):
-                tc = {
-                    'id': entry.guid,
-                    'type': 'function',
-                    'function': {
-                        'name': entry.value,
-                        'arguments': dumps(entry.parameters)
-                    }
-                }
-
-                if last_agent_ctx.get('tool_calls') is None:
-                    last_agent_ctx['tool_calls'] = [tc]
-                else:
-                    # assume this is a list, because we literally just made it
-                    last_agent_ctx['tool_calls'].append(tc)
-
-                if entry.response_id is None:
-                    messages.append({
-                        'role': 'tool',
-                        'content': 'response is async, and is currently working. You will receive a result soon.',
-                        'tool_call_id': entry.guid
-                    })
-            elif isinstance(entry, ToolCallResponseContext):
-                messages.append({
-                    'role': 'tool',
-                    'content': entry.value,
-                    'tool_call_id': entry.call_id
-                })
-            elif isinstance(entry, AgentContext):
-                messages.append({
-                    'role': 'assistant',
-                    'content': entry.value
-                })
-                last_agent_ctx = messages[len(messages) - 1]
-            elif isinstance(entry, SystemPromptContext):
-                messages.append({
-                    'role': 'system',
-                    'content': entry.value
-                })
-
-        tools: list[ChatCompletionToolParam] = []
-
-        for action in self.action_manager.actions.values():
-            tools.append({
-                'function': {
-                    'name': action.name,
-                    'description': action.description,
-                    'parameters': action.parameter_schema
-                },
-                'type': 'function'
-            })
-        for group in self.action_manager.ephemeral_groups.values():
-            for action in group:
-                tools.append({
-                    'function': {
-                        'name': action.name,
-                        'description': action.description,
-                        'parameters': action.parameter_schema
-                    },
-                    'type': 'function'
-                })
-
-        print(dumps(messages, indent=2))
-
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            tools=tools if len(tools) > 0 else NOT_GIVEN,
-            tool_choice=NOT_GIVEN if len(tools) == 0 else 'auto' if
+        self.client = client if client is not None else create_async_client()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # responses by request, set to answer repeated requests without calling the model. Can be shared by agents
+        self.response_cache: ResponseCache | None = None
+
+        # messages are converted once, when their context is added. _entry_messages runs parallel to _ctx and holds
+        # the messages each entry produced, _messages is the flattened list and is None when it needs rebuilding.
+        self._entry_messages: list[list[ChatCompletionMessageParam]] = []
+        self._messages: list[ChatCompletionMessageParam] | None = []
+        self._last_assistant_message: ChatCompletionAssistantMessageParam | None = None
+        # tool calls that haven't got a response yet, mapped to the entry that holds their placeholder message
+        self._placeholders: dict[str, list[ChatCompletionMessageParam]] = {}
+        self._tools: list[ChatCompletionToolParam] = []
+        self._tools_version = -1
+
+        self._converters = {
+            HumanContext: self._convert_human,
+            EnvironmentalContext: self._convert_environmental,
+            ToolCallContext: self._convert_tool_call,
+            ToolCallResponseContext: self._convert_tool_call_response,
+            AgentResponseContext: self._convert_agent_response,
+            SystemPromptContext: self._convert_system_prompt,
+            SummaryContext: self._convert_summary,
+        }
+
+    def _context_inserted(self, position: int, agent_context: AgentContext):
+        converter = self._converters.get(type(agent_context), self._convert_agent_response)
+        converted = converter(agent_context)
+
+        self._entry_messages.insert(position, converted)
+
+        if self._messages is not None and position == len(self._entry_messages) - 1:
+            self._messages.extend(converted)
+        else:
+            self._messages = None
+
+    def _context_reset(self):
+        """Throws away every converted message and converts the whole context again."""
+        self._entry_messages = []
+        self._messages = []
+        self._last_assistant_message = None
+        self._placeholders = {}
+
+        for position, entry in enumerate(self._ctx):
+            self._context_inserted(position, entry)
+
+    def _convert_human(self, entry: HumanContext) -> list[ChatCompletionMessageParam]:
+        return [{"role": "user", "content": entry.value}]
+
+    def _convert_environmental(self, entry: EnvironmentalContext) -> list[ChatCompletionMessageParam]:
+        return [{"role": "system", "content": f"environmental context: {entry.value}"}]
+
+    def _convert_system_prompt(self, entry: SystemPromptContext) -> list[ChatCompletionMessageParam]:
+        return [{'role': 'system', 'content': entry.value}]
+
+    def _convert_summary(self, entry: SummaryContext) -> list[ChatCompletionMessageParam]:
+        return [{'role': 'system', 'content': f'summary of the earlier conversation: {entry.value}'}]
+
+    def _convert_agent_response(self, entry: AgentContext) -> list[ChatCompletionMessageParam]:
+        message: ChatCompletionAssistantMessageParam = {'role': 'assistant', 'content': entry.value}
+        self._last_assistant_message = message
+        return [message]
+
+    def _convert_tool_call(self, entry: ToolCallContext) -> list[ChatCompletionMessageParam]:
+        tc = {
+            'id': entry.guid,
+            'type': 'function',
+            'function': {
+                'name': entry.value,
+                'arguments': dumps(entry.parameters)
+            }
+        }
+
+        # the assistant message is already in the message list, so the call is added to it in place
+        if self._last_assistant_message.get('tool_calls') is None:
+            self._last_assistant_message['tool_calls'] = [tc]
+        else:
+            self._last_assistant_message['tool_calls'].append(tc)
+
+        if entry.response_id is not None:
+            return []
+
+        converted: list[ChatCompletionMessageParam] = [{
+            'role': 'tool',
+            'content': 'response is async, and is currently working. You will receive a result soon.',
+            'tool_call_id': entry.guid
+        }]
+        self._placeholders[entry.guid] = converted
+        return converted
+
+    def _convert_tool_call_response(self, entry: ToolCallResponseContext) -> list[ChatCompletionMessageParam]:
+        placeholder = self._placeholders.pop(entry.call_id, None)
+        if placeholder is not None:
+            placeholder.clear()
+            self._messages = None
+
+        return [{
+            'role': 'tool',
+            'content': entry.value,
+            'tool_call_id': entry.call_id
+        }]
+
+    async def warm_up(self):
+        # opens a connection to the API, so the first response doesn't wait for the TLS handshake
+        try:
+            await self.client.models.list()
+        except Exception as error:
+            logger.debug('could not warm up the connection: %r', error)
+
+    async def summarize_context(self, entries: list[AgentContext]) -> str:
+        """Summarizes evicted context into a few sentences. Meant to be used as a ContextWindow summarizer."""
+        lines = []
+        for entry in entries:
+            if isinstance(entry, ToolCallContext):
+                lines.append(f'called {entry.value} with {dumps(entry.parameters)}')
+            elif entry.value:
+                lines.append(f'{type(entry).__name__.removesuffix("Context").lower()}: {entry.value}')
+
+        messages = [
+            {'role': 'system', 'content': 'Summarize this conversation history in a few short sentences. Keep '
+                                          'names, decisions, facts and anything still unresolved.'},
+            {'role': 'user', 'content': '\n'.join(lines)}
+        ]
+        async with self.request_slot():
+            response = await request_with_retries(
+                lambda: self.client.chat.completions.create(model='gpt-4o-mini', messages=messages), self.retry_policy)
+
+        return response.choices[0].message.content
+
+    def _get_tools(self) -> list[ChatCompletionToolParam]:
+        snapshot = self.action_manager.snapshot()
+        if snapshot.version != self._tools_version:
+            self._tools = [self._convert_action(action) for action in snapshot.actions]
+            self._tools_version = snapshot.version
+
+        return self._tools
+
+    @staticmethod
+    def _convert_action(action: Action) -> ChatCompletionToolParam:
+        return {
+            'function': {
+                'name': action.name,
+                'description': action.description,
+                'parameters': action.parameter_schema
+            },
+            'type': 'function'
+        }
+
+    def _get_messages(self) -> list[ChatCompletionMessageParam]:
+        if self._messages is None:
+            self._messages = [message for converted in self._entry_messages for message in converted]
+
+        return self._messages
+
+    def _convert_pending(self, pending: list[AgentContext]) -> list[ChatCompletionMessageParam]:
+        messages = []
+        for entry in pending:
+            # the other converters update the cached messages, these ones only look at the entry
+            if type(entry) not in (HumanContext, EnvironmentalContext, SystemPromptContext):
+                raise TypeError(f'{type(entry).__name__} can not be pending context')
+            messages.extend(self._converters[type(entry)](entry))
+
+        return messages
+
+    async def _build_request(self, pending: list[AgentContext] | None = None) -> dict:
+        """Builds the keyword arguments for a chat completion request from the cached messages and tools."""
+        await self.fit_context_window()
+
+        with instrumentation.span('build_request'):
+            messages = self._get_messages()
+            if pending:
+                messages = messages + self._convert_pending(pending)
+            tools = self._get_tools()
+
+        # dumping every message is expensive, so it's only done when someone is going to read it
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('request messages: %s', dumps(messages, indent=2))
+
+        return {
+            'model': "gpt-4o",
+            'messages': messages,
+            'tools': tools if len(tools) > 0 else NOT_GIVEN,
+            'tool_choice': NOT_GIVEN if len(tools) == 0 else 'auto' if
             len(self.action_manager.forced_actions_queue) == 0
-            else {'function': {'name': self.action_manager.forced_actions_queue[0]}, 'type': 'function'}
-        )
+            else {'function': {'name': self.action_manager.next_forced_action()}, 'type': 'function'}
+        }
+
+    def _cache_key(self, request: dict) -> str | None:
+        if self.response_cache is None:
+            return None
+        with instrumentation.span('response_cache'):
+            return self.response_cache.chat_key(request)
+
+    def _cached_response(self, cache_key: str | None) -> AgentResponse | None:
+        """Returns a copy of the cached response, with its own tool call contexts so they get new ids."""
+        if cache_key is None:
+            return None
+        cached: AgentResponse | None = self.response_cache.get(cache_key)
+        if cached is None:
+            return None
+
+        logger.debug('response cache hit')
+        tool_calls = None
+        if cached.tool_calls is not None:
+            tool_calls = [ToolCallContext(call.value, call.parameters) for call in cached.tool_calls]
+        return AgentResponse(cached.text_response, tool_calls, cached.finish_reason)
+
+    def _cache_response(self, cache_key: str | None, agent_res: AgentResponse):
+        if cache_key is not None:
+            self.response_cache.put(cache_key, agent_res)
 
+    async def generate_response(self, pending: list[AgentContext] | None = None) -> AgentResponse:
+        # the request is built once, regenerating for a forced action sends the same payload again
+        request = await self._build_request(pending)
+        cache_key = self._cache_key(request)
+        agent_res = self._cached_response(cache_key)
+        if agent_res is not None:
+            return agent_res
+
+        for attempt in range(self.max_forced_action_attempts):
+            async with self.request_slot():
+                with instrumentation.span('llm_request'):
+                    response = await request_with_retries(lambda: self.client.chat.completions.create(**request),
+                                                          self.retry_policy)
+            agent_res = self._parse_completion(response)
+
+            if self.action_manager.response_meets_action_criteria(agent_res):
+                self._record_regenerations(attempt)
+                self._cache_response(cache_key, agent_res)
+                return agent_res
+
+            logger.info('response did not call forced action %s, regenerating',
+                        self.action_manager.next_forced_action())
+
+        self._record_regenerations(self.max_forced_action_attempts)
+        return self._forced_action_fallback(agent_res)
+
+    @staticmethod
+    def _parse_completion(response) -> AgentResponse:
         choice = response.choices[0]
 
         finish_reason = FinishReason.STOP
 
-        print(choice.model_dump_json())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('completion: %s', choice.model_dump_json())
 
         if choice.finish_reason == "tool_calls":
             finish_reason = FinishReason.TOOL_CALL
@@ -113,10 +276,102 @@ class OpenAiAgent(Agent, metaclass=ABCMeta):
             for tool_call in choice.message.tool_calls:
                 tcs.append(ToolCallContext(tool_call.function.name, loads(tool_call.function.arguments)))
 
-        agent_res = AgentResponse(choice.message.content, tcs, finish_reason)
+        return AgentResponse(choice.message.content, tcs, finish_reason)
+
+    async def generate_response_stream(self, pending: list[AgentContext] | None = None) \
+            -> AsyncIterator[Union[str, AgentResponse]]:
+        request = await self._build_request(pending)
+        cache_key = self._cache_key(request)
+        agent_res = self._cached_response(cache_key)
+        if agent_res is not None:
+            # the whole text is already there, so it goes out as one chunk
+            if agent_res.text_response is not None:
+                yield agent_res.text_response
+            yield agent_res
+            return
+
+        # with a forced action queued the response may be thrown away and regenerated, so its text is held back
+        # until it is known to be kept, otherwise every rejected attempt would already have been spoken
+        hold_text = len(self.action_manager.forced_actions_queue) > 0
+
+        for attempt in range(self.max_forced_action_attempts):
+            held: list[str] = []
+            async with self.request_slot():
+                async for item in self._stream_completion(request):
+                    if isinstance(item, AgentResponse):
+                        agent_res = item
+                    elif hold_text:
+                        held.append(item)
+                    else:
+                        yield item
+
+            if self.action_manager.response_meets_action_criteria(agent_res):
+                self._record_regenerations(attempt)
+                self._cache_response(cache_key, agent_res)
+                for delta in held:
+                    yield delta
+                yield agent_res
+                return
+
+            logger.info('response did not call forced action %s, regenerating',
+                        self.action_manager.next_forced_action())
+
+        self._record_regenerations(self.max_forced_action_attempts)
+        fallback = self._forced_action_fallback(agent_res)
+        # the last attempt's text is kept by the fallback, so it is spoken after all
+        for delta in held:
+            yield delta
+        yield fallback
+
+    async def _stream_completion(self, request: dict) -> AsyncIterator[Union[str, AgentResponse]]:
+        # only opening the stream is retried, once text has been yielded it may already have been spoken
+        start = time.perf_counter()
+        stream = await request_with_retries(lambda: self.client.chat.completions.create(**request, stream=True),
+                                            self.retry_policy)
+        first_token = True
+
+        text = ''
+        finish_reason = FinishReason.STOP
+        # tool calls arrive as fragments keyed by their index in the response, the name and arguments are split
+        # across several chunks and have to be joined back together
+        partial_calls: dict[int, dict[str, str]] = {}
+
+        try:
+            async for chunk in stream:
+                if len(chunk.choices) == 0:
+                    continue
+                choice = chunk.choices[0]
+
+                if choice.delta.content:
+                    if first_token:
+                        instrumentation.record('llm_first_token', start)
+                        first_token = False
+                    text += choice.delta.content
+                    yield choice.delta.content
+
+                for tool_call in choice.delta.tool_calls or []:
+                    partial = partial_calls.setdefault(tool_call.index, {'name': '', 'arguments': ''})
+                    if tool_call.function is None:
+                        continue
+                    if tool_call.function.name:
+                        partial['name'] += tool_call.function.name
+                    if tool_call.function.arguments:
+                        partial['arguments'] += tool_call.function.arguments
+
+                if choice.finish_reason == "tool_calls":
+                    finish_reason = FinishReason.TOOL_CALL
+        finally:
+            # a cancelled turn stops reading part way, closing gives the connection back to the pool
+            await stream.close()
+
+        tcs: list[ToolCallContext] | None = None
+
+        if len(partial_calls) > 0:
+            tcs = []
 
-        if not self.action_manager.response_meets_action_criteria(agent_res):
-            print('agent did not respond to criteria')
-            agent_res = self.generate_response()
+            for index in sorted(partial_calls):
+                partial = partial_calls[index]
+                tcs.append(ToolCallContext(partial['name'], loads(partial['arguments'] or '{}')))
 
-        return agent_res
+        instrumentation.record('llm_request', start)
+        yield AgentResponse(text if text != '' else None, tcs, finish_reason)
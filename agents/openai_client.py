@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+# errors that are worth trying again, anything else (bad requests, auth) will fail the same way every time
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
+_shared_http_client: httpx.AsyncClient | None = None
+
+
+def get_shared_http_client() -> httpx.AsyncClient:
+    """Returns the HTTP client shared by every OpenAI client, so they all draw from one keep-alive connection pool."""
+    global _shared_http_client
+    if _shared_http_client is None:
+        _shared_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=120.0),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+
+    return _shared_http_client
+
+
+def create_async_client(base_url: str | None = None, api_key: str | None = None) -> AsyncOpenAI:
+    """Creates an AsyncOpenAI client on the shared connection pool. Pass the base_url of a
+    StubChatCompletionsServer to run against a local stub instead of the real API."""
+    # retries are done by request_with_retries instead, so they can be jittered and hedged
+    return AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=get_shared_http_client(), max_retries=0)
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    # when set, a second identical request is started if the first hasn't answered within this many seconds, and
+    # whichever answers first is used
+    hedge_after: Optional[float] = None
+
+
+async def request_with_retries(make_request: Callable[[], Awaitable[T]], policy: RetryPolicy) -> T:
+    """Runs a request, retrying retryable errors with jittered exponential backoff."""
+    for attempt in range(policy.max_attempts):
+        try:
+            if policy.hedge_after is None:
+                return await make_request()
+            return await _hedged_request(make_request, policy.hedge_after)
+        except RETRYABLE_ERRORS as error:
+            if attempt == policy.max_attempts - 1:
+                raise
+
+            delay = random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** attempt))
+            logger.warning('request failed (%s), retrying in %.2fs', type(error).__name__, delay)
+            await asyncio.sleep(delay)
+
+
+async def _hedged_request(make_request: Callable[[], Awaitable[T]], hedge_after: float) -> T:
+    tasks = {asyncio.ensure_future(make_request())}
+    winner = None
+
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if len(done) == 0:
+            tasks.add(asyncio.ensure_future(make_request()))
+
+        error = None
+        pending = set(tasks)
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result()
+                error = task.exception()
+
+        raise error
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await _close_result(task.result())
+
+
+async def _close_result(result):
+    """Closes the response of a request that lost a hedge, streams would otherwise hold their connection open."""
+    close = getattr(result, 'close', None)
+    if close is not None:
+        closed = close()
+        if asyncio.iscoroutine(closed):
+            await closed
@@ -0,0 +1,169 @@
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Optional, Union
+
+
+@dataclass
+class StubReply:
+    """One scripted reply of the stub server. tool_calls is a list of (function name, arguments) pairs."""
+    content: Optional[str] = None
+    tool_calls: list[tuple[str, dict]] = field(default_factory=list)
+    # seconds before the reply starts, None to use the server's default latency
+    latency: Optional[float] = None
+    # seconds between streamed chunks
+    token_latency: float = 0.0
+    # anything other than 200 is sent as an error, useful for exercising retries
+    status: int = 200
+
+
+StubScript = Union[list[StubReply], Callable[[dict], StubReply]]
+
+
+class StubChatCompletionsServer:
+    """A local stand-in for the chat completions endpoint, for tests and benchmarks. Replies are taken from the
+    script in order, cycling once it runs out, or from calling the script with the request body."""
+    script: StubScript
+    latency: float
+    requests: list[dict]
+
+    def __init__(self, script: StubScript | None = None, latency: float = 0.0, host: str = '127.0.0.1',
+                 port: int = 0):
+        self.script = script if script is not None else [StubReply('ok')]
+        self.latency = latency
+        self.requests = []
+        self._reply_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self) -> str:
+        """Starts serving on a background thread and returns the base url to give the OpenAI client."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_reply(self, body: dict) -> StubReply:
+        with self._lock:
+            self.requests.append(body)
+            if callable(self.script):
+                return self.script(body)
+
+            reply = self.script[self._reply_count % len(self.script)]
+            self._reply_count += 1
+            return reply
+
+    def _create_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                reply = stub._next_reply(body)
+                time.sleep(reply.latency if reply.latency is not None else stub.latency)
+
+                if reply.status != 200:
+                    self._send_json(reply.status, {'error': {'message': 'stub error', 'type': 'server_error'}})
+                elif body.get('stream'):
+                    self._send_stream(body, reply)
+                else:
+                    self._send_json(200, _completion(body, reply))
+
+            def _send_json(self, status: int, payload: dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the request was cancelled, like a speculative response that was started again
+                    self.close_connection = True
+
+            def _send_stream(self, body: dict, reply: StubReply):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                try:
+                    for chunk in _completion_chunks(body, reply):
+                        self._write_chunk(f'data: {json.dumps(chunk)}\n\n'.encode())
+                        time.sleep(reply.token_latency)
+                    self._write_chunk(b'data: [DONE]\n\n')
+                    self._write_chunk(b'')
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on the stream, which hedged requests do on purpose
+                    self.close_connection = True
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+
+        return Handler
+
+
+def _finish_reason(reply: StubReply) -> str:
+    return 'tool_calls' if len(reply.tool_calls) > 0 else 'stop'
+
+
+def _completion(body: dict, reply: StubReply) -> dict:
+    message = {'role': 'assistant', 'content': reply.content}
+    if len(reply.tool_calls) > 0:
+        message['tool_calls'] = [
+            {'id': f'call_{idx}', 'type': 'function', 'function': {'name': name, 'arguments': json.dumps(args)}}
+            for idx, (name, args) in enumerate(reply.tool_calls)
+        ]
+
+    return {
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'stub'),
+        'choices': [{'index': 0, 'message': message, 'finish_reason': _finish_reason(reply)}],
+    }
+
+
+def _completion_chunks(body: dict, reply: StubReply) -> list[dict]:
+    deltas: list[dict] = [{'role': 'assistant'}]
+
+    if reply.content:
+        # a delta per word, keeping the spaces, is close enough to how the real API streams
+        words = reply.content.split(' ')
+        deltas += [{'content': word if idx == 0 else ' ' + word} for idx, word in enumerate(words)]
+
+    for idx, (name, args) in enumerate(reply.tool_calls):
+        arguments = json.dumps(args)
+        half = len(arguments) // 2
+        deltas.append({'tool_calls': [{'index': idx, 'id': f'call_{idx}', 'type': 'function',
+                                       'function': {'name': name, 'arguments': arguments[:half]}}]})
+        deltas.append({'tool_calls': [{'index': idx, 'function': {'arguments': arguments[half:]}}]})
+
+    chunks = [{'index': 0, 'delta': delta, 'finish_reason': None} for delta in deltas]
+    chunks.append({'index': 0, 'delta': {}, 'finish_reason': _finish_reason(reply)})
+
+    return [{
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': body.get('model', 'stub'),
+        'choices': [choice],
+    } for choice in chunks]
@@ -0,0 +1,371 @@
+"""Runs the voice loop of main.py offline, with recorded or synthetic audio in place of the microphone, a local
+stub in place of the OpenAI API, scripted websocket clients running the actions and a null speech sink, then
+reports the throughput and the latency percentiles of every stage.
+
+    python -m bench.voice_loop --turns 50 --llm-latency 0.2 --tool-every 3
+    python -m bench.voice_loop --wav recordings/ --stt faster-whisper --json results.json
+    python -m bench.voice_loop --compare results.json
+
+--compare exits with status 1 when a stage's p95 got more than --tolerance slower than in the given results, so
+it can guard against regressions on an ordinary machine."""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import wave
+from collections import defaultdict
+from functools import partial
+from pathlib import Path
+from typing import AsyncIterator, Callable
+
+import numpy as np
+import websockets
+
+from agent import FinishReason, HumanContext, SystemPromptContext
+from agents.openai_agent import OpenAiAgent
+from agents.openai_client import create_async_client
+from agents.openai_stub_server import StubChatCompletionsServer, StubReply
+from context_window import ContextWindow
+from instrumentation import instrumentation, TurnMetrics
+from providers import create_stt_provider
+from speculation import SpeculativeResponse
+from speech_providers.console_output_speech_provider import ConsoleOutputSpeechProvider
+from speech_providers.null_speech_provider import NullSpeechProvider
+from stt import SAMPLE_RATE, VadSettings, set_stt_provider, set_stt_worker, stream_stt
+from stt_provider import SttProvider
+from stt_worker import SttWorker
+from websocket import WebsocketManager
+from websocket_protocol import CODECS, decode_frame
+
+# lengths in seconds of the noise bursts that stand in for recordings when none are given
+SYNTHETIC_UTTERANCES = [1.5, 2.5, 4.5, 1.0, 6.0]
+
+
+class StageStats:
+    """An exporter that keeps every stage duration of every turn in memory."""
+
+    def __init__(self):
+        self.durations: dict[str, list[float]] = defaultdict(list)
+        self.turns = 0
+
+    def export(self, metrics: TurnMetrics):
+        self.turns += 1
+        for stage, duration in metrics.stage_totals().items():
+            self.durations[stage].append(duration)
+        self.durations['turn'].append(metrics.duration)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        return {stage: {
+            'count': len(durations),
+            'mean': sum(durations) / len(durations),
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'p99': percentile(durations, 99),
+        } for stage, durations in sorted(self.durations.items())}
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Linearly interpolated percentile, q from 0 to 100."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class PlaceholderSttProvider(SttProvider):
+    """Stands in for a model by taking compute_time per second of audio, and transcribes it as a placeholder word
+    for every third of a second."""
+
+    def __init__(self, compute_time: float = 0.05):
+        self.compute_time = compute_time
+
+    def transcribe(self, samples: np.ndarray, sample_rate: int) -> str:
+        seconds = len(samples) / sample_rate
+        time.sleep(seconds * self.compute_time)
+        return ' '.join(['word'] * int(seconds * 3))
+
+
+def read_wav(path: Path) -> np.ndarray:
+    """Reads a 16 bit wav file as mono samples at the sample rate of the STT path."""
+    with wave.open(str(path), 'rb') as file:
+        if file.getsampwidth() != 2:
+            raise ValueError(f'{path} is not 16 bit')
+        samples = np.frombuffer(file.readframes(file.getnframes()), dtype=np.int16)
+        channels = file.getnchannels()
+        rate = file.getframerate()
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    if rate != SAMPLE_RATE:
+        positions = np.arange(0, len(samples), rate / SAMPLE_RATE)
+        samples = np.interp(positions, np.arange(len(samples)), samples).astype(np.int16)
+
+    return samples
+
+
+def synthetic_utterance(seconds: float, seed: int) -> np.ndarray:
+    """Noise loud enough to count as speech, with a little quiet before it."""
+    rng = np.random.default_rng(seed)
+    quiet = rng.normal(0, 30, int(0.3 * SAMPLE_RATE))
+    loud = rng.normal(0, 3000, int(seconds * SAMPLE_RATE))
+    return np.clip(np.concatenate([quiet, loud]), -32768, 32767).astype(np.int16)
+
+
+async def replay_blocks(samples: np.ndarray, settings: VadSettings, realtime: bool) -> AsyncIterator[np.ndarray]:
+    """Yields a recording block by block as the microphone would, followed by enough silence to end it."""
+    block = int(settings.block_length * SAMPLE_RATE)
+    silence = np.zeros(int((settings.end_silence + 0.2) * SAMPLE_RATE), dtype=np.int16)
+    samples = np.concatenate([samples, silence])
+
+    for start in range(0, len(samples), block):
+        yield samples[start:start + block]
+        await asyncio.sleep(settings.block_length if realtime else 0)
+
+
+def chat_script(action_names: list[str], tool_every: int, reply_words: int, token_latency: float):
+    """Replies with a tool call on every tool_every-th user turn, and with text otherwise."""
+    sentence = ' '.join(['word'] * max(reply_words - 1, 0) + ['done.'])
+
+    def script(body: dict) -> StubReply:
+        messages = body['messages']
+        if body.get('model') == 'gpt-4o-mini':
+            return StubReply('a summary of what was said.')
+
+        turn = sum(1 for message in messages if message['role'] == 'user')
+        if tool_every > 0 and len(action_names) > 0 and messages[-1]['role'] == 'user' and turn % tool_every == 0:
+            return StubReply(tool_calls=[(action_names[turn % len(action_names)], {'turn': turn})])
+        return StubReply(sentence, token_latency=token_latency)
+
+    return script
+
+
+async def connect(url: str, attempts: int = 50):
+    """Connects once the server is listening."""
+    for attempt in range(attempts):
+        try:
+            return await websockets.connect(url)
+        except OSError:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(0.02)
+
+
+async def scripted_client(url: str, client_id: str, action_names: list[str], latency: float, encoding: str,
+                          ready: asyncio.Event):
+    """A websocket client that registers the actions and answers every call to them after latency seconds."""
+    codec = CODECS[encoding]
+    actions = [{'name': name, 'description': f'benchmark action {name}',
+                'schema': {'type': 'object', 'properties': {'turn': {'type': 'integer'}}}}
+               for name in action_names]
+
+    async with await connect(url) as websocket:
+        # the hello is always JSON, replies switch to the negotiated encoding after it
+        await websocket.send(json.dumps({'path': 'hello', 'version': 2, 'client_id': client_id,
+                                         'encodings': [encoding]}))
+
+        async def answer(message: dict):
+            await asyncio.sleep(latency)
+            await websocket.send(codec.encode({'path': 'action/result', 'action_id': message['action_id'],
+                                               'result': f'{message["action_name"]} finished'}))
+
+        async for frame in websocket:
+            message = decode_frame(frame)
+            for message in message['messages'] if message.get('type') == 'batch' else [message]:
+                if message.get('type') in ('send_all_actions', 'send_actions'):
+                    names = message.get('names', action_names)
+                    await websocket.send(codec.encode({'path': 'actions/register', 'actions': [
+                        action for action in actions if action['name'] in names]}))
+                    ready.set()
+                elif message.get('type') == 'execute_action':
+                    asyncio.create_task(answer(message))
+
+
+async def run_session(index: int, args, base_url: str, utterances: list[np.ndarray]) -> int:
+    """Runs one agent through its turns, with its own websocket server and clients. Returns how many turns it ran."""
+    if args.tts == 'console':
+        speech_provider = ConsoleOutputSpeechProvider()
+    else:
+        speech_provider = NullSpeechProvider(args.speech_rate)
+    agent = OpenAiAgent(speech_provider, create_async_client(base_url, 'bench'))
+    if args.token_budget is not None:
+        agent.context_window = ContextWindow(token_budget=args.token_budget, summarizer=agent.summarize_context)
+    agent.add_context(SystemPromptContext('You are a benchmark.'))
+
+    port = args.port + index
+    manager = WebsocketManager(agent)
+    server = asyncio.create_task(manager.init_websocket(port=port))
+
+    action_names = [f'bench_action_{idx}' for idx in range(args.actions)]
+    ready_events = []
+    clients = []
+    for idx in range(args.clients):
+        ready = asyncio.Event()
+        ready_events.append(ready)
+        clients.append(asyncio.create_task(scripted_client(f'ws://127.0.0.1:{port}', f'bench-{index}-{idx}',
+                                                           action_names, args.action_latency, args.encoding,
+                                                           ready)))
+    await asyncio.gather(*[ready.wait() for ready in ready_events])
+    # registrations are handled after the client has sent them
+    while len(agent.action_manager.actions) < len(action_names):
+        await asyncio.sleep(0.01)
+
+    settings = VadSettings()
+    try:
+        for turn in range(args.turns):
+            samples = utterances[(turn + index) % len(utterances)]
+            speculation = SpeculativeResponse(agent) if args.speculate else None
+            async for transcript in stream_stt(settings, replay_blocks(samples, settings, args.realtime)):
+                if transcript.is_final:
+                    break
+                if speculation is not None:
+                    speculation.update(transcript.text)
+
+            instrumentation.start_turn(transcript.ended_at)
+            instrumentation.record('stt', transcript.ended_at)
+            speculative = await speculation.finish(transcript.text) if speculation is not None else None
+            agent.add_context(HumanContext(transcript.text))
+
+            try:
+                res = None
+                while res is None or res.finish_reason != FinishReason.STOP:
+                    if speculative is not None:
+                        res, speculative = speculative, None
+                        await agent.add_response_to_context(res, True)
+                        await agent.speak_recent_response()
+                        continue
+                    res = await agent.generate_and_speak_response()
+                    await agent.add_response_to_context(res, True)
+                await agent.wait_for_speech()
+            finally:
+                instrumentation.finish_turn()
+    finally:
+        for client in clients:
+            client.cancel()
+        server.cancel()
+        await asyncio.gather(server, *clients, return_exceptions=True)
+
+    return args.turns
+
+
+def load_utterances(args) -> list[np.ndarray]:
+    paths: list[Path] = []
+    for wav in args.wav or []:
+        path = Path(wav)
+        paths.extend(sorted(path.glob('*.wav')) if path.is_dir() else [path])
+
+    if len(paths) > 0:
+        return [read_wav(path) for path in paths]
+    return [synthetic_utterance(seconds, idx) for idx, seconds in enumerate(SYNTHETIC_UTTERANCES)]
+
+
+def stt_provider_factory(args) -> Callable[[], SttProvider]:
+    """Returns something that creates the provider, picklable so a worker process can create it too."""
+    if args.stt == 'placeholder':
+        return partial(PlaceholderSttProvider, args.stt_compute_time)
+    return partial(create_stt_provider, args.stt)
+
+
+def print_report(summary: dict[str, dict[str, float]], turns: int, elapsed: float):
+    print(f'{turns} turns in {elapsed:.2f}s, {turns / elapsed:.2f} turns/s')
+    print(f'{"stage":<18}{"count":>7}{"mean":>10}{"p50":>10}{"p95":>10}{"p99":>10}  (ms)')
+    for stage, stats in summary.items():
+        print(f'{stage:<18}{stats["count"]:>7}' +
+              ''.join(f'{stats[key] * 1000:>10.1f}' for key in ('mean', 'p50', 'p95', 'p99')))
+
+
+def compare(summary: dict[str, dict[str, float]], baseline_path: str, tolerance: float) -> list[str]:
+    """Returns a line for every stage whose p95 is slower than the baseline allows. A millisecond of slack keeps
+    stages that take next to no time from failing on noise."""
+    baseline = json.loads(Path(baseline_path).read_text())['stages']
+    regressions = []
+    for stage, stats in summary.items():
+        if stage not in baseline:
+            continue
+        allowed = baseline[stage]['p95'] * (1 + tolerance) + 0.001
+        if stats['p95'] > allowed:
+            regressions.append(f'{stage}: p95 {stats["p95"] * 1000:.1f}ms, baseline allows {allowed * 1000:.1f}ms')
+    return regressions
+
+
+async def main(args) -> int:
+    logging.basicConfig(level=args.log_level)
+
+    stt_worker = None
+    if args.stt_worker:
+        stt_worker = SttWorker(stt_provider_factory(args))
+        set_stt_worker(stt_worker)
+    else:
+        set_stt_provider(stt_provider_factory(args)())
+    utterances = load_utterances(args)
+
+    action_names = [f'bench_action_{idx}' for idx in range(args.actions)]
+    stub = StubChatCompletionsServer(chat_script(action_names, args.tool_every, args.reply_words,
+                                                 args.token_latency), latency=args.llm_latency)
+    base_url = stub.start()
+
+    stats = StageStats()
+    instrumentation.exporters.append(stats)
+    instrumentation.enabled = True
+
+    start = time.perf_counter()
+    try:
+        turns = sum(await asyncio.gather(*[run_session(index, args, base_url, utterances)
+                                           for index in range(args.sessions)]))
+    finally:
+        stub.stop()
+        if stt_worker is not None:
+            stt_worker.close()
+    elapsed = time.perf_counter() - start
+
+    summary = stats.summary()
+    print_report(summary, turns, elapsed)
+
+    if args.json is not None:
+        Path(args.json).write_text(json.dumps({'turns': turns, 'elapsed': elapsed, 'turns_per_second':
+                                               turns / elapsed, 'stages': summary}, indent=2))
+
+    if args.compare is not None:
+        regressions = compare(summary, args.compare, args.tolerance)
+        for regression in regressions:
+            print('regression:', regression)
+        return 1 if len(regressions) > 0 else 0
+
+    return 0
+
+
+def parse_args(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description='Benchmarks the voice loop offline.')
+    parser.add_argument('--turns', type=int, default=20, help='turns per session')
+    parser.add_argument('--sessions', type=int, default=1, help='agents running at the same time')
+    parser.add_argument('--wav', nargs='*', help='wav files or directories of them to replay as the user')
+    parser.add_argument('--realtime', action='store_true', help='replay audio at the speed it was recorded')
+    parser.add_argument('--stt', choices=['placeholder', 'faster-whisper', 'whisper'], default='placeholder')
+    parser.add_argument('--stt-compute-time', type=float, default=0.05,
+                        help='seconds the placeholder transcriber takes per second of audio')
+    parser.add_argument('--stt-worker', action='store_true', help='transcribe in a worker process')
+    parser.add_argument('--speculate', action='store_true', help='speculate on partial transcripts')
+    parser.add_argument('--llm-latency', type=float, default=0.1, help='seconds before the stub replies')
+    parser.add_argument('--token-latency', type=float, default=0.005, help='seconds between streamed words')
+    parser.add_argument('--reply-words', type=int, default=30)
+    parser.add_argument('--tool-every', type=int, default=3, help='call an action every n user turns, 0 never')
+    parser.add_argument('--token-budget', type=int, default=None, help='fit the context into this many tokens')
+    parser.add_argument('--actions', type=int, default=4, help='actions registered by each client')
+    parser.add_argument('--clients', type=int, default=2, help='websocket clients per session')
+    parser.add_argument('--action-latency', type=float, default=0.05, help='seconds clients take per action')
+    parser.add_argument('--encoding', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--port', type=int, default=19302, help='first websocket port, one per session')
+    parser.add_argument('--tts', choices=['null', 'console'], default='null')
+    parser.add_argument('--speech-rate', type=float, default=0.0,
+                        help='characters per second the null speech sink takes, 0 to take no time')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='how much slower a p95 may get')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
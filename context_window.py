@@ -0,0 +1,146 @@
+import asyncio
+from typing import Callable, Optional, Coroutine, Union
+from json import dumps
+
+from agent import AgentContext, SystemPromptContext, EnvironmentalContext, ToolCallContext, \
+    ToolCallResponseContext, AgentResponseContext, SummaryContext
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# every message costs a few tokens on top of its content for the role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+Summarizer = Callable[[list[AgentContext]], Union[str, Coroutine[str, None, str]]]
+
+
+def _approximate_token_count(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class ContextWindow:
+    """Keeps an agent's context under a token budget by evicting old entries, optionally replacing them with a
+    summary. System prompts are never evicted and tool calls are always evicted together with their responses."""
+    token_budget: int
+    target_tokens: int
+    keep_recent_turns: int
+    keep_environmental: int
+    summarizer: Optional[Summarizer]
+
+    def __init__(self, token_budget: int = 16000, target_ratio: float = 0.75, keep_recent_turns: int = 4,
+                 keep_environmental: int = 1, summarizer: Optional[Summarizer] = None, model: str = 'gpt-4o'):
+        self.token_budget = token_budget
+        # evicting down to below the budget means the next few entries don't each trigger another eviction
+        self.target_tokens = int(token_budget * target_ratio)
+        self.keep_recent_turns = keep_recent_turns
+        self.keep_environmental = keep_environmental
+        self.summarizer = summarizer
+        self.total_tokens = 0
+
+        if tiktoken is not None:
+            encoding = tiktoken.encoding_for_model(model)
+            self._tokenize: Callable[[str], int] = lambda text: len(encoding.encode(text))
+        else:
+            self._tokenize = _approximate_token_count
+
+    def count_tokens(self, entry: AgentContext) -> int:
+        """Returns the token count of an entry, which is cached on the entry after the first call."""
+        if entry.token_count is None:
+            text = entry.value or ''
+            if isinstance(entry, ToolCallContext):
+                text += dumps(entry.parameters)
+            entry.token_count = self._tokenize(text) + MESSAGE_OVERHEAD_TOKENS
+
+        return entry.token_count
+
+    def added(self, entry: AgentContext) -> bool:
+        """Accounts for a newly added entry. Returns whether the context is now over budget."""
+        self.total_tokens += self.count_tokens(entry)
+        return self.total_tokens > self.token_budget
+
+    async def fit(self, ctx: list[AgentContext]) -> list[AgentContext] | None:
+        """Returns a trimmed copy of the context that fits the budget, or None if nothing had to be evicted."""
+        self.total_tokens = sum(self.count_tokens(entry) for entry in ctx)
+        if self.total_tokens <= self.token_budget:
+            return None
+
+        turns = self._group_turns(ctx)
+        evictable = [idx for idx, turn in enumerate(turns) if self._is_evictable(turn)]
+        # the most recent turns are what the model is currently responding to, so they always stay
+        recent = set(range(max(len(turns) - self.keep_recent_turns, 0), len(turns)))
+        evictable = [idx for idx in evictable if idx not in recent]
+        evicted: set[int] = set()
+
+        # stale environmental updates go first, only the newest few are worth keeping around
+        environmental = [idx for idx in evictable if isinstance(turns[idx][0], EnvironmentalContext)]
+        for idx in environmental[:max(len(environmental) - self.keep_environmental, 0)]:
+            if self.total_tokens <= self.target_tokens:
+                break
+            evicted.add(idx)
+            self.total_tokens -= self._turn_tokens(turns[idx])
+
+        for idx in evictable:
+            if self.total_tokens <= self.target_tokens:
+                break
+            if idx in evicted:
+                continue
+            evicted.add(idx)
+            self.total_tokens -= self._turn_tokens(turns[idx])
+
+        if len(evicted) == 0:
+            return None
+
+        removed = [entry for idx in sorted(evicted) for entry in turns[idx]]
+        kept = [entry for idx, turn in enumerate(turns) if idx not in evicted for entry in turn]
+
+        if self.summarizer is not None:
+            kept = await self._summarize(kept, removed)
+
+        return kept
+
+    async def _summarize(self, kept: list[AgentContext], removed: list[AgentContext]) -> list[AgentContext]:
+        """Folds the removed entries, and any previous summary, into one summary placed after the system prompts."""
+        previous = [entry for entry in kept if isinstance(entry, SummaryContext)]
+        kept = [entry for entry in kept if not isinstance(entry, SummaryContext)]
+
+        summary_text = self.summarizer(previous + removed)
+        if asyncio.iscoroutine(summary_text):
+            summary_text = await summary_text
+
+        summary = SummaryContext(summary_text)
+        self.total_tokens += self.count_tokens(summary) - sum(self.count_tokens(entry) for entry in previous)
+
+        position = 0
+        while position < len(kept) and isinstance(kept[position], SystemPromptContext):
+            position += 1
+        kept.insert(position, summary)
+
+        return kept
+
+    def _turn_tokens(self, turn: list[AgentContext]) -> int:
+        return sum(self.count_tokens(entry) for entry in turn)
+
+    @staticmethod
+    def _is_evictable(turn: list[AgentContext]) -> bool:
+        first = turn[0]
+        if isinstance(first, (SystemPromptContext, SummaryContext)):
+            return False
+        # a call that is still running will have its response inserted after it later
+        return not any(isinstance(entry, ToolCallContext) and entry.response_id is None for entry in turn)
+
+    @staticmethod
+    def _group_turns(ctx: list[AgentContext]) -> list[list[AgentContext]]:
+        """Groups the context into units that can be evicted on their own. Tool calls and their responses belong to
+        the agent response that made them."""
+        turns: list[list[AgentContext]] = []
+
+        for entry in ctx:
+            if isinstance(entry, (ToolCallContext, ToolCallResponseContext)) and len(turns) > 0 and \
+                    isinstance(turns[-1][0], AgentResponseContext):
+                turns[-1].append(entry)
+            else:
+                turns.append([entry])
+
+        return turns
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from json import dumps
+
+from agent import Agent, EnvironmentalContext
+
+_MISSING = object()
+
+
+class EnvironmentCoalescer:
+    """Sits between clients pushing environmental updates and the agent, so a client sending its state many times
+    a second doesn't flood the context. Updates are keyed by source and a newer update replaces an older one that
+    hasn't been forwarded yet.
+
+    An update is forwarded once its source has been quiet for the debounce time, but never more than max_delay
+    after it first arrived, and never sooner than min_interval after the source's last forwarded update. In diff
+    mode only the keys of an object that changed since the last forwarded update are sent, and updates that change
+    nothing are dropped."""
+    debounce: float
+    max_delay: float
+    min_interval: float
+    diff: bool
+
+    def __init__(self, agent: Agent, debounce: float = 0.25, max_delay: float = 1.0, min_interval: float = 1.0,
+                 diff: bool = False):
+        self.agent = agent
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.min_interval = min_interval
+        self.diff = diff
+
+        # source -> (label, value, time the first still pending update arrived)
+        self._pending: dict[str, tuple[str | None, object, float]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._last_sent_at: dict[str, float] = {}
+        self._last_sent_value: dict[str, object] = {}
+
+    def submit(self, source: str, value, label: str | None = None, urgent: bool = False):
+        """Queues an update. label is put in front of the update in the context, to tell the model where it came
+        from. Urgent updates are forwarded right away."""
+        now = time.monotonic()
+        first_pending_at = self._pending[source][2] if source in self._pending else now
+        self._pending[source] = (label, value, first_pending_at)
+
+        timer = self._timers.get(source)
+        if urgent:
+            if timer is not None:
+                timer.cancel()
+            self._flush(source, True)
+            return
+
+        due = min(now + self.debounce, first_pending_at + self.max_delay)
+        due = max(due, self._last_sent_at.get(source, -self.min_interval) + self.min_interval)
+
+        if timer is not None:
+            timer.cancel()
+        self._timers[source] = asyncio.get_running_loop().call_later(max(due - now, 0), self._flush, source)
+
+    def flush_all(self):
+        """Forwards every pending update right away, for when the session is closed so no update is lost."""
+        for source in list(self._pending):
+            self._timers.pop(source).cancel()
+            self._flush(source)
+
+    def forget(self, prefix: str):
+        """Forwards what is still pending from the sources whose names start with prefix, then forgets them, for
+        sources that won't send again such as those of a disconnected client."""
+        for source in [source for source in self._pending if source.startswith(prefix)]:
+            self._timers.pop(source).cancel()
+            self._flush(source)
+
+        for sources in (self._last_sent_at, self._last_sent_value):
+            for source in [source for source in sources if source.startswith(prefix)]:
+                del sources[source]
+
+    def _flush(self, source: str, urgent: bool = False):
+        self._timers.pop(source, None)
+        label, value, _ = self._pending.pop(source)
+        self._last_sent_at[source] = time.monotonic()
+
+        if self.diff:
+            value = self._diff(source, value)
+            if value is _MISSING:
+                return
+
+        text = value if isinstance(value, str) else dumps(value)
+        if label is not None:
+            text = f'{label}: {text}'
+
+        self.agent.add_context(EnvironmentalContext(text, urgent))
+
+    def _diff(self, source: str, value):
+        """Returns what changed since the last forwarded update of the source, or _MISSING if nothing did."""
+        previous = self._last_sent_value.get(source, _MISSING)
+        self._last_sent_value[source] = value
+
+        if not isinstance(value, dict) or not isinstance(previous, dict):
+            return _MISSING if value == previous else value
+
+        changed = {key: item for key, item in value.items() if previous.get(key, _MISSING) != item}
+        removed = [key for key in previous if key not in value]
+        if len(changed) == 0 and len(removed) == 0:
+            return _MISSING
+
+        if len(removed) > 0:
+            changed['removed'] = removed
+        return changed
@@ -0,0 +1,68 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from instrumentation import instrumentation
+
+
+class FairScheduler:
+    """Limits how many of something, like model requests or speech synthesis, run at once across every session.
+    While every slot is taken, waiters queue per session and freed slots go round robin between the sessions that
+    are waiting, so one busy session can't starve the others. Time spent waiting is recorded as a stage of the
+    turn, named after the scheduler."""
+    name: str
+    slots: int
+
+    def __init__(self, slots: int, name: str = 'scheduler'):
+        self.name = name
+        self.slots = slots
+        self._in_use = 0
+        # session -> its waiters in order, sessions are served in the order of this dict and move to the back
+        self._waiting: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, session: str):
+        with instrumentation.span(f'{self.name}_wait'):
+            await self._acquire(session)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def _acquire(self, session: str):
+        if self._in_use < self.slots and len(self._waiting) == 0:
+            self._in_use += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(session, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled after the slot was handed over, it has to be passed on
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self._in_use -= 1
+
+        while len(self._waiting) > 0:
+            session, waiters = next(iter(self._waiting.items()))
+            future = waiters.popleft()
+            if len(waiters) == 0:
+                del self._waiting[session]
+            else:
+                self._waiting.move_to_end(session)
+
+            # waiters that gave up are left in the queue and skipped here
+            if future.cancelled():
+                continue
+
+            self._in_use += 1
+            future.set_result(None)
+            return
@@ -0,0 +1,210 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Protocol
+
+
+@dataclass
+class Span:
+    stage: str
+    # seconds since the start of the turn
+    start: float
+    duration: float
+    detail: str | None = None
+
+
+@dataclass
+class TurnMetrics:
+    """Everything timed during one turn, from hearing the user to finishing speaking."""
+    turn: int
+    started_at: float
+    # time.perf_counter() when the turn started, which span start times are relative to
+    origin: float
+    duration: float = 0.0
+    spans: list[Span] = field(default_factory=list)
+    # the session the turn belongs to, when one process runs several
+    session: str | None = None
+
+    def stage_totals(self) -> dict[str, float]:
+        totals: dict[str, float] = defaultdict(float)
+        for span in self.spans:
+            totals[span.stage] += span.duration
+        return dict(totals)
+
+
+class Exporter(Protocol):
+    def export(self, metrics: TurnMetrics):
+        ...
+
+
+class JsonLinesExporter:
+    """Appends one JSON object per turn to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, metrics: TurnMetrics):
+        record = {
+            'turn': metrics.turn,
+            'session': metrics.session,
+            'started_at': metrics.started_at,
+            'duration': metrics.duration,
+            'stages': metrics.stage_totals(),
+            'spans': [[span.stage, span.detail, span.start, span.duration] for span in metrics.spans],
+        }
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+class PrometheusExporter:
+    """Keeps a histogram of the time spent in each stage and rewrites a file in the Prometheus text format after
+    every turn, for node_exporter's textfile collector or anything else that reads it."""
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, path: str, prefix: str = 'talking_ai'):
+        self.path = path
+        self.prefix = prefix
+        self._counts: dict[str, list[int]] = {}
+        self._sums: dict[str, float] = defaultdict(float)
+
+    def export(self, metrics: TurnMetrics):
+        stages = metrics.stage_totals()
+        stages['turn'] = metrics.duration
+
+        for stage, duration in stages.items():
+            counts = self._counts.setdefault(stage, [0] * (len(self.buckets) + 1))
+            for idx, bucket in enumerate(self.buckets):
+                if duration <= bucket:
+                    counts[idx] += 1
+            counts[-1] += 1
+            self._sums[stage] += duration
+
+        name = f'{self.prefix}_stage_seconds'
+        lines = [f'# HELP {name} Time spent in each stage of a turn.', f'# TYPE {name} histogram']
+        for stage, counts in self._counts.items():
+            for bucket, count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bucket}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {counts[-1]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {self._sums[stage]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {counts[-1]}')
+
+        # written to a temporary file and renamed, so a reader never sees half a file
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.path)
+
+
+class Instrumentation:
+    """Times the stages of each turn. While disabled, or outside of a turn, spans cost one context variable
+    lookup and nothing is recorded."""
+    enabled: bool
+    exporters: list[Exporter]
+
+    def __init__(self):
+        self.enabled = False
+        self.exporters = []
+        self._turn_count = 0
+        self._current: ContextVar[TurnMetrics | None] = ContextVar('current_turn_metrics', default=None)
+
+    def start_turn(self, origin: float | None = None, session: str | None = None):
+        """Starts timing a turn in the current context. origin is the time.perf_counter() value the turn counts
+        from, when it started before it could be known to be a turn, like when the user stopped talking."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if origin is None:
+            origin = now
+        self._turn_count += 1
+        self._current.set(TurnMetrics(self._turn_count, time.time() - (now - origin), origin, session=session))
+
+    @property
+    def in_turn(self) -> bool:
+        return self._current.get() is not None
+
+    def leave_turn(self):
+        """Stops the current context from recording into its turn, which carries on in the tasks started from it."""
+        self._current.set(None)
+
+    def finish_turn(self) -> TurnMetrics | None:
+        metrics = self._current.get()
+        if metrics is None:
+            return None
+        self._current.set(None)
+
+        metrics.duration = time.perf_counter() - metrics.origin
+        for exporter in self.exporters:
+            exporter.export(metrics)
+        return metrics
+
+    @contextmanager
+    def span(self, stage: str, detail: str | None = None):
+        """Times the block as a stage of the current turn. Tasks started during a turn inherit it, so their spans
+        count towards it too."""
+        metrics = self._current.get()
+        if metrics is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            metrics.spans.append(Span(stage, start - metrics.origin, end - start, detail))
+
+    def record(self, stage: str, start: float, detail: str | None = None):
+        """Records a stage that started at the given time.perf_counter() value and ends now, for stages that don't
+        fit in a with block."""
+        metrics = self._current.get()
+        if metrics is None:
+            return
+        end = time.perf_counter()
+        metrics.spans.append(Span(stage, start - metrics.origin, end - start, detail))
+
+
+class StartupProfile:
+    """Times the steps of starting up, counted from when this module was first imported, which is about when the
+    process started. Steps may overlap, such as models warming up in the background. For a breakdown of every
+    import run with python -X importtime."""
+    origin: float
+    # name, seconds since the origin it started, and how long it took, or None while it is still running
+    steps: list[tuple[str, float, float | None]]
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        index = len(self.steps)
+        self.steps.append((name, start - self.origin, None))
+        try:
+            yield
+        finally:
+            self.steps[index] = (name, start - self.origin, time.perf_counter() - start)
+
+    def mark(self, name: str):
+        """Records a point in startup, like when the server started listening."""
+        self.steps.append((name, time.perf_counter() - self.origin, 0.0))
+
+    def report(self) -> str:
+        lines = [f'{"at":>8}{"took":>9}  step (s)']
+        for name, start, duration in sorted(self.steps, key=lambda step: step[1]):
+            took = f'{duration:9.3f}' if duration is not None else f'{"...":>9}'
+            lines.append(f'{start:8.3f}{took}  {name}')
+        return '\n'.join(lines)
+
+    def write(self, path: str):
+        with open(path, 'w') as file:
+            json.dump([{'step': name, 'at': start, 'took': duration} for name, start, duration in self.steps], file,
+                      indent=2)
+
+
+instrumentation = Instrumentation()
+startup = StartupProfile()
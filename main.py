@@ -1,94 +1,196 @@
 import asyncio
-import time
-from threading import Thread
+import logging
+import os
+from functools import partial
 from dotenv import load_dotenv
-from agent import HumanContext, Action, FinishReason, AgentContext, EnvironmentalContext, SystemPromptContext
-from agents.openai_agent import OpenAiAgent
-from speech_providers.styletts2_speech_provider import StyleTTS2SpeechProvider as Sp
-from stt import stt
+from agent import HumanContext, FinishReason, SystemPromptContext, ForcedActionNotUsedError, AgentResponse, Agent
+from context_window import ContextWindow
+from instrumentation import instrumentation, startup, JsonLinesExporter, PrometheusExporter
+from providers import create_agent, create_speech_provider, create_stt_provider
+from response_cache import ResponseCache
+from session_store import SessionStore
+from speculation import SpeculativeResponse
+from stt import stt, stream_stt, set_stt_worker
+from stt_worker import SttWorker
+from turn_scheduler import TurnScheduler
 from websocket import WebsocketManager
 
 load_dotenv()
 
-agent = OpenAiAgent(Sp())
-
-wait_run_without_human: asyncio.Future | None = None
-on_env_ctx_added = -1
-
-
-def on_context_added(ctx: AgentContext):
-    global on_env_ctx_added
-    if isinstance(ctx, EnvironmentalContext):
-        on_env_ctx_added = time.time()
-
-
-# async def monitoring_env_ctx():
-#     global on_env_ctx_added
-#     while True:
-#         if on_env_ctx_added != -1 and time.time() - on_env_ctx_added > 4:
-#             if wait_run_without_human is not None:
-#                 wait_run_without_human.set_result(None)
-#         await asyncio.sleep(1)
-
-agent.context_added_notifiers.append(on_context_added)
-
-agent.add_context(SystemPromptContext(
-    "You are a TTS ai. Keep responses speakable and short. Dont make lists. Be decisive. No markdown is allowed."))
-
-
-async def main():
-    global wait_run_without_human
-    global on_env_ctx_added
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING'),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('main')
+
+
+def setup() -> tuple[Agent, SttWorker]:
+    # per turn latency breakdowns, as JSON lines and/or a Prometheus text file. Set up here rather than on import,
+    # the spawned workers import this module too and have no turns to export
+    if os.environ.get('LATENCY_LOG'):
+        instrumentation.exporters.append(JsonLinesExporter(os.environ['LATENCY_LOG']))
+    if os.environ.get('LATENCY_PROMETHEUS'):
+        instrumentation.exporters.append(PrometheusExporter(os.environ['LATENCY_PROMETHEUS']))
+    instrumentation.enabled = len(instrumentation.exporters) > 0
+
+    # capturing, transcribing and synthesizing run in worker processes, so the event loop only handles the agent and
+    # the websocket. The providers are picked with the STT_PROVIDER, SPEECH_PROVIDER and AGENT environment variables
+    # and only their modules are imported, the models load in the workers while the agent is already running
+    with startup.step('start stt worker'):
+        stt_worker = SttWorker(partial(create_stt_provider, os.environ.get('STT_PROVIDER', 'faster-whisper'),
+                                       model_size=os.environ.get('STT_MODEL', 'base.en'), beam_size=1))
+    set_stt_worker(stt_worker)
+    with startup.step('create agent'):
+        agent = create_agent(create_speech_provider())
+
+    agent.context_window = ContextWindow(token_budget=16000, summarizer=agent.summarize_context)
+
+    # repeated requests, and calls to actions registered as idempotent, are answered from memory for this many seconds
+    if os.environ.get('RESPONSE_CACHE_TTL'):
+        agent.response_cache = ResponseCache(ttl=float(os.environ['RESPONSE_CACHE_TTL']))
+        agent.action_manager.result_cache = ResponseCache(ttl=float(os.environ['RESPONSE_CACHE_TTL']))
+
+    with startup.step('restore session'):
+        session_store = SessionStore('session.db')
+        agent.restore_context(session_store)
+
+    if len(agent._ctx) == 0:
+        agent.add_context(SystemPromptContext(
+            "You are a TTS ai. Keep responses speakable and short. Dont make lists. Be decisive. No markdown is "
+            "allowed."))
+
+    return agent, stt_worker
+
+
+async def warm_up(agent: Agent, stt_worker: SttWorker, websocket_manager: WebsocketManager):
+    """Runs every model once in the background, while the websocket server and the first turn are already live. A
+    turn that needs a model before it is warm waits for it, as it would have at startup."""
+    async def step(name: str, warming):
+        with startup.step(name):
+            try:
+                await warming
+            except Exception as error:
+                logger.warning('%s failed: %r', name, error)
+
+    await asyncio.gather(step('start websocket server', websocket_manager.listening.wait()),
+                         step('warm up agent', agent.warm_up()),
+                         step('warm up speech', asyncio.to_thread(agent.speech_provider.warm_up)),
+                         step('warm up stt', asyncio.to_thread(stt_worker.warm_up)))
+
+    logger.info('startup profile:\n%s', startup.report())
+    if os.environ.get('STARTUP_PROFILE'):
+        startup.write(os.environ['STARTUP_PROFILE'])
+
+
+async def main(agent: Agent, stt_worker: SttWorker):
     use_stt = True
+    # listen for speech on its own instead of waiting for the push to talk keys
+    use_vad = True
     auto_prompt = False
+    stream_speech = True
+    # start generating a response from partial transcripts while the user is still talking, only used with vad
+    speculate = True
+    # keep listening while the agent responds, and interrupt it once the user's words are transcribed. Without
+    # headphones the agent hears itself, so leave this off when using speakers
+    barge_in = False
     websocket_manager = WebsocketManager(agent)
+    scheduler = TurnScheduler(agent)
 
     # Create the websocket task and await it in the background
     websocket_task = asyncio.create_task(websocket_manager.init_websocket())
-    # asyncio.create_task(monitoring_env_ctx())
+    warm_up_task = asyncio.create_task(warm_up(agent, stt_worker, websocket_manager))
 
     loop = asyncio.get_running_loop()
 
-    wait_run_without_human = loop.create_future()
-
-    try:
-        while True:
-            # Run blocking input in an executor to avoid blocking the event loop
-            # tasks = [asyncio.create_task(stt()), wait_run_without_human]
-            # done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            # user_input = done.pop().result()
-            # if user_input is None:
-            #     print('sorry user, you have been interrupted.')
-            #     pending.pop().cancel()
-            #     on_env_ctx_added = -1
-            #     wait_run_without_human = loop.create_future()
-            # else:
-            #     agent.add_context(HumanContext(user_input))
-            if not auto_prompt:
-                if use_stt:
-                    text = await stt()
-                else:
-                    text = await loop.run_in_executor(None, input, 'speak to it: ')
-                print('you said ' + text)
-                agent.add_context(HumanContext(text))
+    async def respond(speculative: AgentResponse | None = None):
+        if not instrumentation.in_turn:
+            instrumentation.start_turn()
 
+        try:
             res = None
-            while res is None or res.finish_reason != FinishReason.STOP:
-                res = agent.generate_response()
-                await agent.add_response_to_context(res, True)
+            try:
+                while res is None or res.finish_reason != FinishReason.STOP:
+                    if speculative is not None:
+                        res, speculative = speculative, None
+                        await agent.add_response_to_context(res, True)
+                        if stream_speech:
+                            # it was generated before it could be spoken, so it is spoken in one go
+                            await agent.speak_recent_response()
+                        continue
+                    if stream_speech:
+                        res = await agent.generate_and_speak_response()
+                    else:
+                        res = await agent.generate_response()
+                    await agent.add_response_to_context(res, True)
+            except ForcedActionNotUsedError as error:
+                logger.warning("%s", error)
+                return
+
+            if not stream_speech:
+                await agent.speak_recent_response()
+
+            await agent.wait_for_speech()
+        finally:
+            instrumentation.finish_turn()
+
+    # urgent environmental context gets a response right away, without waiting for the user
+    scheduler.urgent_turn = respond
+
+    startup.mark('ready for the first turn')
 
-            agent.speak_recent_response()
+    try:
+        while True:
+            if auto_prompt:
+                await scheduler.start(respond)
+                continue
+
+            speculative = None
+            if use_stt and use_vad:
+                speculation = SpeculativeResponse(agent) if speculate else None
+                async for transcript in stream_stt():
+                    if transcript.is_final:
+                        break
+                    if barge_in and transcript.text:
+                        scheduler.preempt('the user started talking')
+                    if speculation is not None:
+                        speculation.update(transcript.text)
+                text = transcript.text
+                # the turn is timed from when the user stopped talking
+                instrumentation.start_turn(transcript.ended_at)
+                instrumentation.record('stt', transcript.ended_at)
+                if speculation is not None:
+                    speculative = await speculation.finish(text)
+            elif use_stt:
+                text = await stt()
+                instrumentation.start_turn()
+            else:
+                text = await loop.run_in_executor(None, input, 'speak to it: ')
+                instrumentation.start_turn()
+            print('you said ' + text)
+            agent.add_context(HumanContext(text))
+
+            scheduler.start(partial(respond, speculative), 'the user said something new')
+            # the turn's task carries on timing it, listening for the next one isn't part of it
+            instrumentation.leave_turn()
+
+            if not barge_in:
+                # speech plays without blocking the loop, but the next turn shouldn't start listening over it
+                await scheduler.wait()
 
     except asyncio.CancelledError:
         print("Main function cancelled, shutting down...")
 
     finally:
+        scheduler.preempt('shutting down')
+        warm_up_task.cancel()
         # Ensure websocket_task is awaited and handled
         websocket_task.cancel()
         try:
             await websocket_task
         except asyncio.CancelledError:
             print("Websocket task cancelled and shut down gracefully.")
+        stt_worker.close()
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    # the worker processes are spawned, which imports this module again in each of them, so nothing may be started
+    # on import
+    asyncio.run(main(*setup()))
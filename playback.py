@@ -0,0 +1,71 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import sounddevice as sd
+
+
+class PlaybackQueue:
+    """Plays audio buffers one after another through a single output stream that stays open, so queueing audio
+    never blocks. Every queued buffer gets a future that resolves to True once it has been played, or False if it
+    was cancelled first."""
+    sample_rate: int
+
+    def __init__(self, sample_rate: int, blocksize: int = 1024):
+        self.sample_rate = sample_rate
+        self._buffers: deque[tuple[np.ndarray, Future]] = deque()
+        # how far into the first buffer playback has got
+        self._position = 0
+        self._lock = threading.Lock()
+        self._stream = sd.OutputStream(samplerate=sample_rate, channels=1, dtype='float32', blocksize=blocksize,
+                                       callback=self._callback)
+        self._stream.start()
+
+    def enqueue(self, wav: np.ndarray) -> Future:
+        """Queues a buffer to play after everything already queued. Safe to call from any thread, wrap the future
+        with asyncio.wrap_future to await it."""
+        future = Future()
+        with self._lock:
+            self._buffers.append((np.asarray(wav, dtype=np.float32).reshape(-1), future))
+        return future
+
+    def cancel(self):
+        """Stops playback and drops everything queued, for when the user talks over the agent."""
+        with self._lock:
+            cancelled = list(self._buffers)
+            self._buffers.clear()
+            self._position = 0
+
+        for _, future in cancelled:
+            future.set_result(False)
+
+    @property
+    def is_playing(self) -> bool:
+        return len(self._buffers) > 0
+
+    def close(self):
+        self.cancel()
+        self._stream.close()
+
+    def _callback(self, outdata, frames, time, status):
+        filled = 0
+        finished = []
+
+        with self._lock:
+            while filled < frames and len(self._buffers) > 0:
+                wav, future = self._buffers[0]
+                count = min(frames - filled, len(wav) - self._position)
+                outdata[filled:filled + count, 0] = wav[self._position:self._position + count]
+                filled += count
+                self._position += count
+
+                if self._position >= len(wav):
+                    self._buffers.popleft()
+                    self._position = 0
+                    finished.append(future)
+
+        outdata[filled:] = 0
+
+        for future in finished:
+            future.set_result(True)
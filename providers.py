@@ -0,0 +1,56 @@
+import importlib
+import os
+import sys
+
+from instrumentation import startup
+
+# Everything that can be picked in the config, by name. Modules are only imported once something of theirs is
+# created, so a provider's dependencies are only loaded when it is used.
+
+SPEECH_PROVIDERS = {
+    'styletts2': 'speech_providers.styletts2_speech_provider:StyleTTS2SpeechProvider',
+    'windows': 'speech_providers.windows_speech_provider:WindowsTTSProvider',
+    'console': 'speech_providers.console_output_speech_provider:ConsoleOutputSpeechProvider',
+    'null': 'speech_providers.null_speech_provider:NullSpeechProvider',
+}
+
+STT_PROVIDERS = {
+    'faster-whisper': 'stt_providers.faster_whisper_stt_provider:FasterWhisperSttProvider',
+    'whisper': 'stt_providers.whisper_stt_provider:WhisperSttProvider',
+}
+
+AGENTS = {
+    'openai': 'agents.openai_agent:OpenAiAgent',
+}
+
+
+def load(registry: dict[str, str], name: str) -> type:
+    """Imports and returns the class registered under name."""
+    if name not in registry:
+        raise ValueError(f'unknown provider {name!r}, expected one of {", ".join(registry)}')
+
+    module_name, class_name = registry[name].split(':')
+    module = sys.modules.get(module_name)
+    if module is None:
+        with startup.step(f'import {module_name}'):
+            module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def create_speech_provider(name: str | None = None, **kwargs):
+    """Creates the speech provider named in the SPEECH_PROVIDER environment variable when no name is given."""
+    name = name if name is not None else os.environ.get('SPEECH_PROVIDER', 'styletts2')
+    return load(SPEECH_PROVIDERS, name)(**kwargs)
+
+
+def create_stt_provider(name: str | None = None, **kwargs):
+    """Creates the STT provider named in the STT_PROVIDER environment variable when no name is given. A
+    functools.partial of this can be given to an SttWorker, the provider is then only imported in the worker."""
+    name = name if name is not None else os.environ.get('STT_PROVIDER', 'faster-whisper')
+    return load(STT_PROVIDERS, name)(**kwargs)
+
+
+def create_agent(speech_provider, name: str | None = None, **kwargs):
+    """Creates the agent named in the AGENT environment variable when no name is given."""
+    name = name if name is not None else os.environ.get('AGENT', 'openai')
+    return load(AGENTS, name)(speech_provider, **kwargs)
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+def normalize_chat_request(request: dict) -> dict:
+    """Returns a copy of a chat completion request with its tool call ids, which are random for every call, replaced
+    by the order they first appear in. Nothing else is changed, so requests only share a key when they are the same
+    apart from those ids."""
+    call_ids: dict[str, str] = {}
+
+    def call_id(value: str) -> str:
+        return call_ids.setdefault(value, f'call_{len(call_ids)}')
+
+    messages = []
+    for message in request.get('messages', []):
+        if message.get('tool_calls'):
+            message = {**message, 'tool_calls': [{**call, 'id': call_id(call['id'])} for call in message['tool_calls']]}
+        if message.get('tool_call_id') is not None:
+            message = {**message, 'tool_call_id': call_id(message['tool_call_id'])}
+        messages.append(message)
+
+    return {**request, 'messages': messages}
+
+
+class ResponseCache:
+    """An LRU cache whose entries also expire ttl seconds after they were added. Keys are hashes of payloads, use
+    chat_key for chat completion requests so requests that only differ in tool call ids share an entry. Counts hits
+    and misses, expired entries count as misses."""
+    max_entries: int
+    ttl: float
+    hits: int
+    misses: int
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (when it expires, value)
+        self._entries: OrderedDict[str, tuple[float, object]] = OrderedDict()
+
+    @staticmethod
+    def key(payload) -> str:
+        # anything json can't encode, like the openai client's NOT_GIVEN, is left out of the key by its type name
+        encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'),
+                             default=lambda value: type(value).__name__)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    @classmethod
+    def chat_key(cls, request: dict) -> str:
+        return cls.key(normalize_chat_request(request))
+
+    def get(self, key: str):
+        """Returns the value for the key, or None if there isn't one or it has expired."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hit_rate(self) -> float | None:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else None
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from agents.openai_agent import OpenAiAgent
+from agents.openai_client import create_async_client
+from context_window import ContextWindow
+from response_cache import ResponseCache
+from session_manager import SessionManager
+from speech_providers.null_speech_provider import NullSpeechProvider
+
+# Serves many conversations at once, one per session_id clients send in their hello. Unlike main.py there is no
+# microphone, clients say things as the user over the websocket and get the agent's responses back.
+
+load_dotenv()
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('server')
+
+SYSTEM_PROMPT = "You are a TTS ai. Keep responses speakable and short. Dont make lists. Be decisive. " \
+                "No markdown is allowed."
+
+
+async def main():
+    # every session speaks through one pool of synthesis workers, instead of a model per session
+    worker_pool = None
+    synthesis_cache = None
+    if os.environ.get('SERVER_TTS') == 'styletts2':
+        from speech_providers.styletts2_pool import StyleTTS2WorkerPool
+        from speech_providers.styletts2_speech_provider import StyleTTS2SpeechProvider, DEFAULT_VOICE_PATH
+        from speech_providers.synthesis_cache import SynthesisCache
+
+        worker_pool = StyleTTS2WorkerPool(os.environ.get('SERVER_VOICE', DEFAULT_VOICE_PATH),
+                                          int(os.environ.get('SERVER_TTS_PROCESSES', 2)))
+        # and one cache, so a phrase synthesized for one session is reused by the others
+        synthesis_cache = SynthesisCache()
+
+    client = create_async_client(os.environ.get('OPENAI_BASE_URL'))
+
+    # shared by every session, keys cover the whole request so sessions only share identical conversations. Action
+    # results are only shared within a session, since clients of different sessions can answer differently
+    response_cache = None
+    if os.environ.get('RESPONSE_CACHE_TTL'):
+        response_cache = ResponseCache(max_entries=1024, ttl=float(os.environ['RESPONSE_CACHE_TTL']))
+
+    def create_agent(session_id: str) -> OpenAiAgent:
+        if worker_pool is not None:
+            # nothing is played on the server, each session's clients are sent its audio
+            speech_provider = StyleTTS2SpeechProvider(cache=synthesis_cache, worker_pool=worker_pool, playback=False)
+        else:
+            speech_provider = NullSpeechProvider()
+
+        agent = OpenAiAgent(speech_provider, client)
+        agent.context_window = ContextWindow(token_budget=16000, summarizer=agent.summarize_context)
+        if response_cache is not None:
+            agent.response_cache = response_cache
+            agent.action_manager.result_cache = ResponseCache(ttl=response_cache.ttl)
+        return agent
+
+    manager = SessionManager(
+        create_agent,
+        store_path=os.environ.get('SERVER_SESSIONS', 'sessions.db'),
+        system_prompt=SYSTEM_PROMPT,
+        idle_timeout=float(os.environ.get('SERVER_IDLE_TIMEOUT', 600)),
+        max_active_sessions=int(os.environ.get('SERVER_MAX_SESSIONS', 64)),
+        llm_slots=int(os.environ.get('SERVER_LLM_SLOTS', 8)),
+        speech_slots=int(os.environ.get('SERVER_TTS_SLOTS', worker_pool.processes if worker_pool else 2)),
+    )
+
+    async def report_periodically():
+        while True:
+            await asyncio.sleep(60)
+            logger.info('sessions: %s', json.dumps(manager.report()))
+
+    reporting = asyncio.create_task(report_periodically())
+    try:
+        await manager.serve(os.environ.get('SERVER_HOST', '127.0.0.1'), int(os.environ.get('SERVER_PORT', 9302)))
+    finally:
+        reporting.cancel()
+        if worker_pool is not None:
+            worker_pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
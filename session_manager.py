@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import sys
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable
+
+import websockets
+from websockets import ConnectionClosed
+from websockets.asyncio.server import ServerConnection
+
+from agent import Agent, FinishReason, ForcedActionNotUsedError, HumanContext, SystemPromptContext
+from fair_scheduler import FairScheduler
+from instrumentation import instrumentation, TurnMetrics
+from session_store import SessionStore
+from turn_scheduler import TurnScheduler
+from websocket import WebsocketManager, ClientConnection
+from websocket_protocol import InvalidMessage, create_deflate_extension, decode_frame, encode_pcm
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_ID = 'default'
+
+
+@dataclass
+class SessionStats:
+    """What a session has used, kept while it is evicted so it adds up over its whole life."""
+    turns: int = 0
+    turn_seconds: float = 0.0
+    last_turn_seconds: float = 0.0
+    # total seconds per stage, including time spent waiting for a shared model client or synthesizer
+    stage_seconds: dict[str, float] = field(default_factory=dict)
+    # how many times the session was brought back from disk after being evicted
+    restores: int = 0
+
+
+class Session:
+    """One conversation: an agent with its own actions and context, the websocket clients connected to it and the
+    turns it is running. Turns are started by clients saying something as the user, or by urgent environmental
+    context, and every response is sent to the session's clients. So is the speech of providers that don't play it
+    themselves, as agent/audio messages."""
+    session_id: str
+    agent: Agent
+
+    def __init__(self, session_id: str, agent: Agent, store: SessionStore, stats: SessionStats,
+                 websocket_manager: WebsocketManager):
+        self.session_id = session_id
+        self.agent = agent
+        self.store = store
+        self.stats = stats
+        self.websocket_manager = websocket_manager
+        self.scheduler = TurnScheduler(agent)
+        self.scheduler.urgent_turn = self.respond
+        self.last_active = time.monotonic()
+
+        websocket_manager.human_context_notifiers.append(self._on_human_context)
+        agent.context_added_notifiers.append(lambda _: self.touch())
+        audio_notifiers = getattr(agent.speech_provider, 'audio_notifiers', None)
+        if audio_notifiers is not None:
+            audio_notifiers.append(self._on_audio)
+
+    @property
+    def busy(self) -> bool:
+        return len(self.websocket_manager.connections) > 0 or self.scheduler.running
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def memory_estimate(self) -> int:
+        """Roughly how many bytes the session's context takes, not counting what agents convert it into."""
+        return sum(sys.getsizeof(entry) + sys.getsizeof(entry.value) for entry in self.agent._ctx)
+
+    def _on_human_context(self, client: ClientConnection, context: HumanContext):
+        self.scheduler.start(self.respond, 'the user said something new')
+
+    def _on_audio(self, text: str, wav):
+        asyncio.create_task(self.websocket_manager.broadcast({
+            'type': 'agent/audio',
+            'text': text,
+            'sample_rate': self.agent.speech_provider.sample_rate,
+            'pcm': encode_pcm(wav),
+        }))
+
+    async def respond(self):
+        instrumentation.start_turn(session=self.session_id)
+        try:
+            res = None
+            while res is None or res.finish_reason != FinishReason.STOP:
+                res = await self.agent.generate_and_speak_response()
+                await self.agent.add_response_to_context(res, True)
+                if res.text_response:
+                    await self.websocket_manager.broadcast({'type': 'agent/response', 'text': res.text_response})
+
+            await self.agent.wait_for_speech()
+        except ForcedActionNotUsedError as error:
+            logger.warning('session %s: %s', self.session_id, error)
+        finally:
+            instrumentation.finish_turn()
+            self.touch()
+
+    def close(self):
+        """Writes the session to disk. The agent can't be used afterwards."""
+        self.scheduler.preempt('the session was evicted')
+        self.websocket_manager.environment_coalescer.flush_all()
+        self.store.snapshot(self.agent._ctx)
+        self.store.close()
+        # a restored session gets a new agent, so this one's playback stream and threads would never be freed
+        self.agent.speech_provider.close()
+
+
+class SessionManager:
+    """Runs many conversations in one process. Every session has its own agent, made by create_agent, and clients
+    pick their session with a session_id in their hello, clients that don't go to the default session.
+
+    Agents share one model client and synthesizer through fair schedulers, so at most llm_slots requests and
+    speech_slots syntheses run at once and sessions take turns on them. Sessions with no clients and no running
+    turn for idle_timeout seconds are written to the session store and dropped from memory, and so are the least
+    recently active idle sessions when there are more than max_active_sessions. They are brought back from the store
+    when a client connects to them again."""
+    idle_timeout: float
+    max_active_sessions: int
+
+    def __init__(self, create_agent: Callable[[str], Agent], store_path: str = 'sessions.db',
+                 system_prompt: str | None = None, idle_timeout: float = 600.0, max_active_sessions: int = 64,
+                 llm_slots: int = 8, speech_slots: int = 2, heartbeat_interval: float = 10.0,
+                 heartbeat_timeout: float = 10.0, legacy_handshake_timeout: float = 0.5):
+        self.create_agent = create_agent
+        self.store_path = store_path
+        self.system_prompt = system_prompt
+        self.idle_timeout = idle_timeout
+        self.max_active_sessions = max_active_sessions
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.legacy_handshake_timeout = legacy_handshake_timeout
+
+        self.llm_scheduler = FairScheduler(llm_slots, 'llm')
+        self.speech_scheduler = FairScheduler(speech_slots, 'tts')
+        self.sessions: dict[str, Session] = {}
+        # kept for every session ever seen, including evicted ones
+        self.stats: dict[str, SessionStats] = {}
+
+        instrumentation.exporters.append(self)
+        instrumentation.enabled = True
+
+    def get(self, session_id: str) -> Session:
+        """Returns a session, creating it or bringing it back from the session store if it isn't in memory."""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.touch()
+            return session
+
+        stats = self.stats.get(session_id)
+        if stats is None:
+            stats = self.stats[session_id] = SessionStats()
+        else:
+            stats.restores += 1
+
+        agent = self.create_agent(session_id)
+        agent.request_slot = partial(self.llm_scheduler.slot, session_id)
+        agent.speech_slot = partial(self.speech_scheduler.slot, session_id)
+
+        store = SessionStore(self.store_path, session_id)
+        agent.restore_context(store)
+        if len(agent._ctx) == 0 and self.system_prompt is not None:
+            agent.add_context(SystemPromptContext(self.system_prompt))
+
+        websocket_manager = WebsocketManager(agent, self.heartbeat_interval, self.heartbeat_timeout,
+                                             self.legacy_handshake_timeout)
+        session = Session(session_id, agent, store, stats, websocket_manager)
+        self.sessions[session_id] = session
+        logger.info('session %s loaded, %d in memory', session_id, len(self.sessions))
+
+        self._evict_over_limit(keep=session_id)
+        return session
+
+    def evict(self, session_id: str):
+        session = self.sessions.pop(session_id)
+        session.close()
+        logger.info('session %s evicted, %d in memory', session_id, len(self.sessions))
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if not session.busy and now - session.last_active >= self.idle_timeout:
+                self.evict(session.session_id)
+
+    def _evict_over_limit(self, keep: str | None = None):
+        """Evicts the least recently active idle sessions until there are at most max_active_sessions, or there are
+        no more idle ones. keep is never evicted, it is the session that is about to be used."""
+        idle = sorted((session for session in self.sessions.values()
+                       if not session.busy and session.session_id != keep),
+                      key=lambda session: session.last_active)
+        for session in idle[:max(len(self.sessions) - self.max_active_sessions, 0)]:
+            self.evict(session.session_id)
+
+    def export(self, metrics: TurnMetrics):
+        stats = self.stats.get(metrics.session)
+        if stats is None:
+            return
+
+        stats.turns += 1
+        stats.turn_seconds += metrics.duration
+        stats.last_turn_seconds = metrics.duration
+        for stage, duration in metrics.stage_totals().items():
+            stats.stage_seconds[stage] = stats.stage_seconds.get(stage, 0.0) + duration
+
+    def report(self) -> dict[str, dict]:
+        """Per session accounting, for every session seen so far."""
+        report = {}
+        for session_id, stats in self.stats.items():
+            session = self.sessions.get(session_id)
+            report[session_id] = {
+                'in_memory': session is not None,
+                'connections': len(session.websocket_manager.connections) if session is not None else 0,
+                'context_entries': len(session.agent._ctx) if session is not None else None,
+                'memory_bytes': session.memory_estimate() if session is not None else 0,
+                'turns': stats.turns,
+                'mean_turn_seconds': stats.turn_seconds / stats.turns if stats.turns > 0 else None,
+                'last_turn_seconds': stats.last_turn_seconds,
+                'stage_seconds': dict(stats.stage_seconds),
+                'restores': stats.restores,
+            }
+        return report
+
+    async def _evict_idle_periodically(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1.0))
+            self.evict_idle()
+
+    async def manage(self, websocket: ServerConnection):
+        try:
+            first_frame = await asyncio.wait_for(websocket.recv(), self.legacy_handshake_timeout)
+        except asyncio.TimeoutError:
+            first_frame = None
+        except ConnectionClosed:
+            return
+
+        session_id = DEFAULT_SESSION_ID
+        if first_frame is not None:
+            try:
+                first = decode_frame(first_frame)
+                if first.get('path') == 'hello':
+                    session_id = str(first.get('session_id', DEFAULT_SESSION_ID))
+            except (InvalidMessage, AttributeError):
+                pass
+
+        session = self.get(session_id)
+        try:
+            await session.websocket_manager.manage(websocket, first_frame)
+        finally:
+            session.touch()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9302):
+        evicting = asyncio.create_task(self._evict_idle_periodically())
+        try:
+            async with websockets.serve(self.manage, host, port, ping_interval=self.heartbeat_interval,
+                                        ping_timeout=self.heartbeat_timeout, compression=None,
+                                        extensions=[create_deflate_extension()]):
+                await asyncio.Future()
+        finally:
+            evicting.cancel()
+            for session_id in list(self.sessions):
+                self.evict(session_id)
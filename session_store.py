@@ -0,0 +1,112 @@
+import json
+import sqlite3
+from typing import Iterator
+
+from agent import AgentContext, EnvironmentalContext, HumanContext, ToolCallContext, ToolCallResponseContext, \
+    AgentResponseContext, SystemPromptContext, SummaryContext
+
+CONTEXT_TYPES: dict[str, type[AgentContext]] = {cls.__name__: cls for cls in (
+    EnvironmentalContext, HumanContext, ToolCallContext, ToolCallResponseContext, AgentResponseContext,
+    SystemPromptContext, SummaryContext
+)}
+
+
+def serialize_context(entry: AgentContext) -> dict:
+    data = {'type': type(entry).__name__, 'guid': entry.guid, 'value': entry.value}
+    if type(entry) is ToolCallContext:
+        data['parameters'] = entry.parameters
+    elif type(entry) is ToolCallResponseContext:
+        data['call_id'] = entry.call_id
+    return data
+
+
+def deserialize_context(data: dict) -> AgentContext:
+    cls = CONTEXT_TYPES[data['type']]
+    if cls is ToolCallContext:
+        entry = ToolCallContext(data['value'], data['parameters'])
+    elif cls is ToolCallResponseContext:
+        entry = ToolCallResponseContext(data['value'], data['call_id'])
+    else:
+        entry = cls(data['value'])
+
+    entry.guid = data['guid']
+    return entry
+
+
+class SessionStore:
+    """An append-only log of an agent's context, kept in SQLite so a restarted agent can pick up where it left off.
+
+    Every added entry is a row in events, holding the position it was inserted at and the entry as JSON. Every
+    snapshot_every events, and whenever the context is replaced as a whole, the full context is written to snapshots
+    and the events it covers are deleted. Loading is the latest snapshot with the events after it replayed on top.
+    Both tables are plain JSON, so replay tools can read them with nothing but sqlite3."""
+    path: str
+    session_id: str
+    snapshot_every: int
+
+    def __init__(self, path: str, session_id: str = 'default', snapshot_every: int = 500):
+        self.path = path
+        self.session_id = session_id
+        self.snapshot_every = snapshot_every
+        self._events_since_snapshot = 0
+
+        self._db = sqlite3.connect(path)
+        # WAL makes each append a cheap sequential write rather than a full sync of the database
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT '
+                         'NOT NULL, position INTEGER NOT NULL, entry TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS snapshots (session TEXT NOT NULL, seq INTEGER NOT NULL, '
+                         'entries TEXT NOT NULL, PRIMARY KEY (session, seq))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS events_session ON events (session, seq)')
+        self._db.commit()
+
+    def append(self, position: int, entry: AgentContext, ctx: list[AgentContext]):
+        """Logs an entry that was inserted into ctx at the given position."""
+        self._db.execute('INSERT INTO events (session, position, entry) VALUES (?, ?, ?)',
+                         (self.session_id, position, json.dumps(serialize_context(entry))))
+        self._db.commit()
+
+        self._events_since_snapshot += 1
+        if self._events_since_snapshot >= self.snapshot_every:
+            self.snapshot(ctx)
+
+    def snapshot(self, ctx: list[AgentContext]):
+        """Writes the whole context and drops every event and snapshot it replaces."""
+        # the last seq ever handed out, not the highest left in events, which are deleted by the snapshots before
+        # this one. Otherwise a snapshot taken before any new event would sort before the one it replaces
+        row = self._db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+        seq = row[0] if row is not None else 0
+        entries = json.dumps([serialize_context(entry) for entry in ctx])
+
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO snapshots (session, seq, entries) VALUES (?, ?, ?)',
+                             (self.session_id, seq, entries))
+            self._db.execute('DELETE FROM snapshots WHERE session = ? AND seq < ?', (self.session_id, seq))
+            self._db.execute('DELETE FROM events WHERE session = ? AND seq <= ?', (self.session_id, seq))
+
+        self._events_since_snapshot = 0
+
+    def iter_events(self, after_seq: int = 0) -> Iterator[tuple[int, int, dict]]:
+        """Yields (seq, position, serialized entry) for every logged event after after_seq."""
+        rows = self._db.execute('SELECT seq, position, entry FROM events WHERE session = ? AND seq > ? ORDER BY seq',
+                                (self.session_id, after_seq))
+        for seq, position, entry in rows:
+            yield seq, position, json.loads(entry)
+
+    def load(self) -> list[AgentContext]:
+        """Rebuilds the context from the latest snapshot and the events logged after it."""
+        row = self._db.execute('SELECT seq, entries FROM snapshots WHERE session = ? ORDER BY seq DESC LIMIT 1',
+                               (self.session_id,)).fetchone()
+        seq, ctx = 0, []
+        if row is not None:
+            seq = row[0]
+            ctx = [deserialize_context(data) for data in json.loads(row[1])]
+
+        for _, position, data in self.iter_events(seq):
+            ctx.insert(position, deserialize_context(data))
+
+        return ctx
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,105 @@
+import time
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from stt import RingBuffer
+
+# the number of samples ever written, then how far the reader has got, as int64s in front of the samples
+_HEADER_FIELDS = 2
+_HEADER_SIZE = _HEADER_FIELDS * 8
+
+
+@dataclass(frozen=True)
+class PcmRange:
+    """Where audio was written in a SharedRingBuffer, sent between processes instead of the audio itself."""
+    ring: str
+    start: int
+    end: int
+
+
+class SharedRingBuffer(RingBuffer):
+    """A RingBuffer in shared memory, so audio can be passed between processes without pickling it. One process
+    writes and others attach to it by its spec. Positions are in the shared header, a reader sees a write once the
+    writer has moved written past it.
+
+    The writer can also wait for the reader, for audio that must not be overwritten before it has been read. The
+    reader marks what it has read with consume."""
+
+    def __init__(self, capacity: int, dtype=np.int16, name: str | None = None):
+        dtype = np.dtype(dtype)
+        self._owner = name is None
+        self._memory = shared_memory.SharedMemory(name=name, create=self._owner,
+                                                  size=_HEADER_SIZE + capacity * dtype.itemsize)
+        self._header = np.ndarray(_HEADER_FIELDS, dtype=np.int64, buffer=self._memory.buf)
+        self._data = np.ndarray(capacity, dtype=dtype, buffer=self._memory.buf, offset=_HEADER_SIZE)
+        if self._owner:
+            self._header[:] = 0
+
+    @classmethod
+    def attach(cls, spec: tuple[str, int, str]) -> "SharedRingBuffer":
+        name, capacity, dtype = spec
+        return cls(capacity, dtype, name)
+
+    @property
+    def spec(self) -> tuple[str, int, str]:
+        """Everything another process needs to attach to the buffer, and small enough to send to it."""
+        return self.name, self.capacity, self._data.dtype.str
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    @property
+    def written(self) -> int:
+        return int(self._header[0])
+
+    @written.setter
+    def written(self, value: int):
+        # the samples are already in place, so readers can't see the new position before the audio it covers
+        self._header[0] = value
+
+    @property
+    def consumed(self) -> int:
+        return int(self._header[1])
+
+    def consume(self, end: int):
+        """Marks everything before end as read, letting a waiting writer reuse the space."""
+        self._header[1] = max(end, self.consumed)
+
+    def write_range(self, samples: np.ndarray, wait: bool = False, timeout: float = 10.0) -> PcmRange:
+        """Writes samples and returns where they went. With wait, first waits until the reader has consumed enough
+        that nothing unread is overwritten, raising TimeoutError if it hasn't after timeout seconds. Raises
+        ValueError for more samples than the ring holds, since they could never be read back whole."""
+        if len(samples) > self.capacity:
+            raise ValueError(f'{len(samples)} samples do not fit in a ring of {self.capacity}')
+
+        if wait:
+            deadline = time.monotonic() + timeout
+            while self.written + len(samples) - self.consumed > self.capacity:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f'the reader of {self.name} has not made room for {len(samples)} samples')
+                time.sleep(0.002)
+
+        start = self.written
+        self.write(samples)
+        return PcmRange(self.name, start, self.written)
+
+    def read_range(self, pcm_range: PcmRange) -> np.ndarray:
+        """Reads a range written by write_range and marks it as consumed."""
+        samples = self.read(pcm_range.start, pcm_range.end)
+        self.consume(pcm_range.end)
+        return samples
+
+    def close(self):
+        """Detaches from the buffer, and frees it if this process created it."""
+        # shared memory can't be closed while numpy arrays still point into it
+        del self._header, self._data
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from difflib import SequenceMatcher
+
+from agent import Agent, AgentResponse, HumanContext
+from instrumentation import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_similarity(prefix: str, text: str) -> float:
+    """How alike prefix is to the start of text, from 0 to 1, compared word by word so casing and spacing don't
+    count. Words text has past the length of prefix don't count either, so a transcript that kept going still
+    matches the partial one it grew from."""
+    prefix_words = prefix.lower().split()
+    return SequenceMatcher(None, prefix_words, text.lower().split()[:len(prefix_words)]).ratio()
+
+
+class SpeculativeResponse:
+    """Starts generating a response from partial transcripts while the user is still talking, so most of the time
+    spent waiting on the model overlaps with the end of what they are saying.
+
+    Each partial transcript is passed to update. A response is started once a transcript has at least min_words,
+    and is cancelled and started again when a later transcript no longer starts with one at least min_similarity
+    alike to the one it was started from, or has grown so that it is less than min_coverage of the words. finish
+    takes the final transcript and returns the response if it was generated from a transcript that matches it the
+    same way and nothing else was added to the context in the meantime, otherwise None and the response has to be
+    generated as usual."""
+    min_similarity: float
+    min_words: int
+    min_coverage: float
+
+    def __init__(self, agent: Agent, min_similarity: float = 0.85, min_words: int = 3, min_coverage: float = 0.5):
+        self.agent = agent
+        self.min_similarity = min_similarity
+        self.min_words = min_words
+        self.min_coverage = min_coverage
+
+        self._text: str | None = None
+        self._task: asyncio.Task | None = None
+        # the context and action registry versions the response was started at
+        self._versions: tuple[int, int] | None = None
+        # how many responses were started, every one after the first was a transcript that changed too much
+        self.started = 0
+
+    def _current_versions(self) -> tuple[int, int]:
+        return self.agent.context_version, self.agent.action_manager.version
+
+    def _matches(self, text: str) -> bool:
+        """Whether the response started from the speculated transcript still answers text."""
+        coverage = len(self._text.split()) / max(len(text.split()), 1)
+        return coverage >= self.min_coverage and prefix_similarity(self._text, text) >= self.min_similarity
+
+    def update(self, text: str):
+        if len(text.split()) < self.min_words:
+            return
+        if self._task is not None and self._versions == self._current_versions() and self._matches(text):
+            return
+
+        self.cancel()
+        self._text = text
+        self._versions = self._current_versions()
+        self._task = asyncio.create_task(self.agent.generate_response([HumanContext(text)]))
+        self.started += 1
+
+    async def finish(self, text: str) -> AgentResponse | None:
+        """Must be called before the final transcript is added to the context."""
+        if self._task is None:
+            return None
+
+        if not self._matches(text):
+            logger.debug('final transcript differs from the speculated one, discarding it')
+            self.cancel()
+            return None
+        if self._versions != self._current_versions():
+            logger.debug('context changed since the speculative response was started, discarding it')
+            self.cancel()
+            return None
+
+        try:
+            with instrumentation.span('llm_request', 'speculative'):
+                response = await self._task
+        except Exception as error:
+            logger.warning('speculative response failed: %r', error)
+            return None
+        finally:
+            self._task = None
+
+        # context that arrived while the response was finishing wasn't seen by it
+        if self._versions != self._current_versions():
+            logger.debug('context changed since the speculative response was started, discarding it')
+            return None
+
+        return response
+
+    def cancel(self):
+        if self._task is not None:
+            if self._task.done() and not self._task.cancelled():
+                # a response that failed after it was superseded isn't worth reporting
+                self._task.exception()
+            self._task.cancel()
+            self._task = None
@@ -1,7 +1,93 @@
 import abc
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 
 class SpeechProvider(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def generate_speech(self, text: str):
+        """Speaks text, blocking until it has been spoken."""
         pass
+
+    async def speak(self, text: str) -> asyncio.Future:
+        """Starts speaking text and returns once it no longer needs the caller, usually when it has been
+        synthesized. The returned future resolves to True once the text has been heard, or False if it was
+        cancelled. Calling speak again while earlier text is playing queues the new text after it."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._get_speech_executor(), self._generate_speech_and_confirm, text,
+                                    self.speech_generation)
+
+    @property
+    def speech_generation(self) -> int:
+        """Goes up every time speech is cancelled, text queued before then is no longer spoken."""
+        return getattr(self, '_speech_generation', 0)
+
+    def cancel_speech(self):
+        """Stops speaking and drops anything queued to be spoken. Providers overriding this have to call it too, so
+        text already queued on the speech thread is skipped."""
+        self._speech_generation = self.speech_generation + 1
+
+    def warm_up(self):
+        """Blocks until the provider is ready to speak quickly, such as once its model has loaded and run once.
+        Called on a background thread at startup, while the agent is already running."""
+        pass
+
+    def close(self):
+        """Stops speaking and frees whatever the provider holds, it can't be used afterwards."""
+        self.cancel_speech()
+        executor = getattr(self, '_speech_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _generate_speech_and_confirm(self, text: str, generation: int) -> bool:
+        if generation != self.speech_generation:
+            return False
+
+        self.generate_speech(text)
+        # cancelled while speaking, so it may not have been heard to the end
+        return generation == self.speech_generation
+
+    def _get_speech_executor(self) -> ThreadPoolExecutor:
+        # a single thread, so utterances from a blocking provider are spoken in order and never overlap
+        executor = getattr(self, '_speech_executor', None)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='speech')
+            self._speech_executor = executor
+        return executor
+
+
+class SpeechChunker:
+    """Splits a stream of text deltas into sentence or clause sized chunks that can be spoken on their own."""
+    sentence_end = re.compile(r'[.!?]+["\')\]]*\s+')
+    clause_end = re.compile(r'[,;:]\s+')
+
+    def __init__(self, min_clause_length: int = 60):
+        # clauses are only split off once this much text is waiting, so short replies stay a single utterance
+        self.min_clause_length = min_clause_length
+        self._buffer = ''
+
+    def feed(self, delta: str) -> list[str]:
+        """Adds a text delta and returns any chunks that are now complete."""
+        self._buffer += delta
+        chunks = []
+
+        while True:
+            match = self.sentence_end.search(self._buffer)
+            if match is None and len(self._buffer) >= self.min_clause_length:
+                match = self.clause_end.search(self._buffer)
+            if match is None:
+                break
+
+            chunk = self._buffer[:match.end()].strip()
+            self._buffer = self._buffer[match.end():]
+            if chunk != '':
+                chunks.append(chunk)
+
+        return chunks
+
+    def flush(self) -> str:
+        """Returns whatever text is left over once the stream has ended."""
+        rest = self._buffer.strip()
+        self._buffer = ''
+        return rest
@@ -0,0 +1,16 @@
+import time
+from abc import ABCMeta
+
+from speech_provider import SpeechProvider
+
+
+class NullSpeechProvider(SpeechProvider, metaclass=ABCMeta):
+    """Speaks into nothing, for agents whose responses are only read. With chars_per_second set it takes as long as
+    saying the text would."""
+
+    def __init__(self, chars_per_second: float = 0.0):
+        self.chars_per_second = chars_per_second
+
+    def generate_speech(self, text: str):
+        if self.chars_per_second > 0:
+            time.sleep(len(text) / self.chars_per_second)
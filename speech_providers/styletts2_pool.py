@@ -0,0 +1,120 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from shared_ring import PcmRange, SharedRingBuffer
+from speech_providers.styletts2_worker import synthesis_worker
+
+# how often the result reader checks that the workers are still running
+WORKER_CHECK_INTERVAL = 1.0
+
+
+class StyleTTS2WorkerPool:
+    """Synthesis worker processes shared by every StyleTTS2SpeechProvider given the pool, so many sessions can
+    speak with the same voice without loading a model each. Requests go to whichever worker is free first, and a
+    thread matches the results back to their requests. Each worker returns waveforms through its own shared memory
+    ring."""
+    voice_path: str
+
+    def __init__(self, voice_path: str, processes: int = 2, sample_rate: int = 24000, ring_seconds: float = 60.0):
+        self.voice_path = voice_path
+
+        context = multiprocessing.get_context('spawn')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._rings = {ring.name: ring for ring in
+                       (SharedRingBuffer(int(sample_rate * ring_seconds), np.float32) for _ in range(processes))}
+        self._workers = [context.Process(target=synthesis_worker, args=(voice_path, self._requests, self._results,
+                                                                        ring.spec), daemon=True)
+                         for ring in self._rings.values()]
+        for worker in self._workers:
+            worker.start()
+
+        self._ids = itertools.count()
+        self._pending: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        # set once a worker has died, requests it took would never be answered so the pool fails every request
+        self._error: Exception | None = None
+        self._closing = False
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+
+    @property
+    def processes(self) -> int:
+        return len(self._workers)
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                future.set_exception(self._error)
+                return future
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        self._requests.put((request_id, text))
+        return future
+
+    def synthesize(self, text: str) -> np.ndarray:
+        return self.submit(text).result()
+
+    def warm_up(self, text: str = 'Hello there.'):
+        """Waits for every worker to load its model and run it once. Workers take requests as they become free, so
+        sending one per worker reaches each of them unless one finishes before another has loaded."""
+        for future in [self.submit(text) for _ in self._workers]:
+            future.result()
+
+    def _read_results(self):
+        while True:
+            try:
+                message = self._results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if message is None:
+                break
+
+            request_id, result = message
+            # anything else is a worker's ready message
+            if request_id == 'ready':
+                continue
+
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                # already failed because a worker died
+                if isinstance(result, PcmRange):
+                    self._rings[result.ring].consume(result.end)
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            elif isinstance(result, PcmRange):
+                future.set_result(self._rings[result.ring].read_range(result))
+            else:
+                future.set_result(result)
+
+    def _check_workers(self):
+        dead = [worker for worker in self._workers if not worker.is_alive()]
+        if len(dead) == 0 or self._closing:
+            return
+
+        with self._lock:
+            if self._error is None:
+                self._error = RuntimeError(f'a synthesis worker exited with code {dead[0].exitcode}')
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.set_exception(self._error)
+
+    def close(self):
+        self._closing = True
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._reader.join()
+        for ring in self._rings.values():
+            ring.close()
@@ -1,16 +1,158 @@
 from abc import ABCMeta
-from styletts2 import tts
+import asyncio
+import multiprocessing
+import queue
+import threading
+from typing import Callable
+
+import numpy as np
+
+from shared_ring import PcmRange, SharedRingBuffer
 from speech_provider import SpeechProvider
-import sounddevice as sd
+from speech_providers.styletts2_pool import StyleTTS2WorkerPool
+from speech_providers.styletts2_worker import load_model, synthesis_worker
+from speech_providers.synthesis_cache import SynthesisCache
+
+DEFAULT_VOICE_PATH = './speech_providers/sample/voice.mp3'
+WARM_UP_TEXT = 'Hello there.'
+# how often a wait for the worker checks that it is still running
+WORKER_CHECK_INTERVAL = 1.0
 
 
 class StyleTTS2SpeechProvider(SpeechProvider, metaclass=ABCMeta):
-    def __init__(self):
-        self.tts = tts.StyleTTS2()
+    sample_rate = 24000
+
+    def __init__(self, voice_path: str = DEFAULT_VOICE_PATH, cache: SynthesisCache | None = None,
+                 use_worker_process: bool = True, worker_pool: StyleTTS2WorkerPool | None = None,
+                 playback: bool = True):
+        """With a worker pool, synthesis happens in the pool's processes in the pool's voice, and the provider
+        starts no worker of its own. Without playback no output stream is opened, every synthesized waveform is
+        passed to the audio_notifiers instead, such as for a server to send it to its clients."""
+        self.voice_path = voice_path if worker_pool is None else worker_pool.voice_path
+        self.worker_pool = worker_pool
+        self.cache = cache if cache is not None else SynthesisCache()
+        # the worker answers requests in order, so only one request may be waiting on it at a time
+        self._lock = threading.Lock()
+        self._request_count = 0
+        # called with the text and its waveform, when there is no playback
+        self.audio_notifiers: list[Callable[[str, np.ndarray], ...]] = []
+        self._playback = None
+        if playback:
+            # only imported when playing, it needs an audio device
+            from playback import PlaybackQueue
+            self._playback = PlaybackQueue(self.sample_rate)
+
+        if worker_pool is not None:
+            self._worker = None
+        elif use_worker_process:
+            context = multiprocessing.get_context('spawn')
+            self._requests = context.Queue()
+            self._results = context.Queue()
+            # waveforms come back through shared memory, a minute of audio fits before the worker has to wait
+            self._ring = SharedRingBuffer(self.sample_rate * 60, np.float32)
+            self._worker = context.Process(target=synthesis_worker, args=(voice_path, self._requests, self._results,
+                                                                          self._ring.spec), daemon=True)
+            self._worker.start()
+        else:
+            self._worker = None
+            self._model, self._style = load_model(voice_path)
+
+    def synthesize(self, text: str) -> np.ndarray:
+        wav = self.cache.get(text, self.voice_path)
+        if wav is not None:
+            return wav
+
+        if self.worker_pool is not None:
+            wav = self.worker_pool.synthesize(text)
+            self.cache.put(text, self.voice_path, wav)
+            return wav
+
+        with self._lock:
+            if self._worker is None:
+                wav = self._model.inference(text, ref_s=self._style)
+            else:
+                wav = self._synthesize_in_worker(text)
+
+        self.cache.put(text, self.voice_path, wav)
+        return wav
+
+    def _synthesize_in_worker(self, text: str) -> np.ndarray:
+        self._request_count += 1
+        self._requests.put((self._request_count, text))
+
+        while True:
+            try:
+                request_id, result = self._results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                # a worker that failed to load its model or was killed would otherwise be waited on forever
+                if not self._worker.is_alive():
+                    raise RuntimeError(f'the synthesis worker exited with code {self._worker.exitcode}')
+                continue
+
+            # anything else is the worker's ready message
+            if request_id == self._request_count:
+                break
+
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, PcmRange):
+            return self._ring.read_range(result)
+        return result
+
+    def warm_up(self):
+        # the first inference is much slower than the rest, it is done here on text that is never played. The
+        # cache is skipped, it would otherwise answer every warm up after the first
+        if self.worker_pool is not None:
+            self.worker_pool.warm_up()
+            return
+
+        with self._lock:
+            if self._worker is None:
+                self._model.inference(WARM_UP_TEXT, ref_s=self._style)
+            else:
+                self._synthesize_in_worker(WARM_UP_TEXT)
 
     def generate_speech(self, text: str):
-        wav = self.tts.inference(text, target_voice_path='./speech_providers/sample/voice.mp3')
+        wav = self.synthesize(text)
+        if self._playback is None:
+            self._notify_audio(text, wav)
+        else:
+            self._playback.enqueue(wav).result()
+
+    async def speak(self, text: str) -> asyncio.Future:
+        # only synthesis is waited on, so the next utterance can be synthesized while this one plays
+        loop = asyncio.get_running_loop()
+        generation = self.speech_generation
+        wav = await loop.run_in_executor(self._get_speech_executor(), self.synthesize, text)
+        # cancelled while it was being synthesized
+        if generation != self.speech_generation:
+            skipped = loop.create_future()
+            skipped.set_result(False)
+            return skipped
+
+        if self._playback is not None:
+            return asyncio.wrap_future(self._playback.enqueue(wav))
+
+        # whoever plays it is told about it, this side can't know when it has been heard
+        self._notify_audio(text, wav)
+        handed_over = loop.create_future()
+        handed_over.set_result(True)
+        return handed_over
+
+    def _notify_audio(self, text: str, wav: np.ndarray):
+        for notifier in self.audio_notifiers:
+            notifier(text, wav)
 
-        sd.play(wav, 24000)
+    def cancel_speech(self):
+        super().cancel_speech()
+        if self._playback is not None:
+            self._playback.cancel()
 
-        sd.wait()
\ No newline at end of file
+    def close(self):
+        if self._playback is not None:
+            self._playback.close()
+        if self._worker is not None:
+            self._requests.put(None)
+            self._worker.join()
+            self._ring.close()
+        super().close()
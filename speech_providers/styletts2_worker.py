@@ -0,0 +1,42 @@
+from multiprocessing import Queue
+
+import numpy as np
+
+from shared_ring import SharedRingBuffer
+
+
+def load_model(voice_path: str):
+    """Loads StyleTTS2 and computes the style vector of the reference voice, which only has to be done once."""
+    from styletts2 import tts
+
+    model = tts.StyleTTS2()
+    return model, model.compute_style(voice_path)
+
+
+def synthesis_worker(voice_path: str, requests: Queue, results: Queue, ring_spec: tuple | None = None):
+    """Runs in its own process, so inference doesn't hold the GIL of the process running the event loop. Takes
+    (request id, text) pairs until it is sent None, and answers each with (request id, result). The result is an
+    exception if synthesis failed. Given a shared ring, the waveform is written to it and the result is its PcmRange,
+    otherwise, or when it doesn't fit or the ring isn't read in time, the result is the waveform itself."""
+    model, style = load_model(voice_path)
+    ring = SharedRingBuffer.attach(ring_spec) if ring_spec is not None else None
+    results.put(('ready', None))
+
+    for request_id, text in iter(requests.get, None):
+        try:
+            wav = np.asarray(model.inference(text, ref_s=style), dtype=np.float32).reshape(-1)
+        except Exception as error:
+            results.put((request_id, error))
+            continue
+
+        if ring is None or len(wav) > ring.capacity:
+            results.put((request_id, wav))
+            continue
+
+        try:
+            results.put((request_id, ring.write_range(wav, wait=True)))
+        except TimeoutError:
+            results.put((request_id, wav))
+
+    if ring is not None:
+        ring.close()
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SynthesisCache:
+    """An LRU cache of synthesized waveforms, keyed by text and voice. Recently used waveforms are kept in memory
+    and every waveform is also saved to disk, so common phrases survive restarts. Safe to share between providers
+    synthesizing on different threads."""
+    max_entries: int
+    directory: str | None
+    max_disk_entries: int
+
+    def __init__(self, max_entries: int = 128, directory: str | None = './speech_providers/cache',
+                 max_disk_entries: int = 2048):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text: str, voice: str) -> str:
+        return hashlib.sha256(f'{voice}\0{text}'.encode()).hexdigest()
+
+    def get(self, text: str, voice: str) -> np.ndarray | None:
+        key = self.key(text, voice)
+
+        with self._lock:
+            wav = self._memory.get(key)
+            if wav is not None:
+                self._memory.move_to_end(key)
+                return wav
+
+            path = self._path(key)
+            if path is None:
+                return None
+
+            try:
+                wav = np.load(path)
+                # touching the file keeps it from being the next one pruned
+                os.utime(path)
+            except FileNotFoundError:
+                # not cached, or pruned by another process sharing the directory
+                return None
+
+            self._remember(key, wav)
+            return wav
+
+    def put(self, text: str, voice: str, wav: np.ndarray):
+        key = self.key(text, voice)
+        with self._lock:
+            self._remember(key, wav)
+
+            path = self._path(key)
+            if path is not None:
+                # written beside and then renamed over, so nothing ever loads a half written file
+                partial_path = f'{path}.{os.getpid()}.{threading.get_ident()}.partial'
+                with open(partial_path, 'wb') as file:
+                    np.save(file, wav)
+                os.replace(partial_path, path)
+                self._prune_disk()
+
+    def _remember(self, key: str, wav: np.ndarray):
+        self._memory[key] = wav
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str | None:
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, f'{key}.npy')
+
+    def _prune_disk(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.npy')]
+        if len(entries) <= self.max_disk_entries:
+            return
+
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_disk_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -4,15 +4,32 @@ from speech_provider import SpeechProvider
 
 class WindowsTTSProvider(SpeechProvider):
     def __init__(self):
-        # Initialize the TTS engine
-        self.engine = pyttsx3.init()
+        # the engine is created on the speech thread the first time it is used, pyttsx3 engines have to stay on the
+        # thread that created them
+        self.engine = None
 
-        # Optionally, you can set properties such as rate, volume, and voice
-        self.engine.setProperty('rate', 150)  # Speed of speech
-        self.engine.setProperty('volume', 1)  # Volume (0.0 to 1.0)
+    def _get_engine(self):
+        if self.engine is None:
+            # Initialize the TTS engine
+            self.engine = pyttsx3.init()
+
+            # Optionally, you can set properties such as rate, volume, and voice
+            self.engine.setProperty('rate', 150)  # Speed of speech
+            self.engine.setProperty('volume', 1)  # Volume (0.0 to 1.0)
+
+            # stop() is only safe on the engine's own thread, so speech is interrupted from its word callback
+            self.engine.connect('started-word', self._stop_if_cancelled)
+
+        return self.engine
 
     def generate_speech(self, text: str):
+        engine = self._get_engine()
+        self._speaking_generation = self.speech_generation
         # Use the engine to say the text
-        self.engine.say(text)
+        engine.say(text)
         # Blocks while processing all currently queued commands
-        self.engine.runAndWait()
+        engine.runAndWait()
+
+    def _stop_if_cancelled(self, name, location, length):
+        if self._speaking_generation != self.speech_generation:
+            self.engine.stop()
@@ -1,9 +1,248 @@
 import asyncio
-import keyboard
-import sounddevice as sd
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, TYPE_CHECKING
+
 import numpy as np
 import threading
-import speech_recognition as sr
+
+from stt_provider import SttProvider
+
+if TYPE_CHECKING:
+    from stt_worker import SttWorker
+
+SAMPLE_RATE = 16000  # Sample rate required by Whisper
+
+logger = logging.getLogger(__name__)
+
+_stt_provider: SttProvider | None = None
+_stt_worker: "SttWorker | None" = None
+
+# chunks are transcribed one at a time and in order, on a thread so the event loop keeps running
+_transcription_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stt')
+
+
+@dataclass
+class Transcript:
+    text: str
+    # partial transcripts cover what has been said so far, the final one covers the whole utterance
+    is_final: bool
+    # time.perf_counter() when the end of the utterance was detected, set on the final transcript
+    ended_at: float | None = None
+
+
+@dataclass
+class VadSettings:
+    # a block counts as speech when its RMS is above both of these, the noise floor follows the background level
+    min_threshold: float = 400.0
+    noise_ratio: float = 3.0
+    # seconds of audio kept from before speech was detected, so the first syllable isn't clipped
+    pre_roll: float = 0.3
+    # seconds of silence that end the utterance
+    end_silence: float = 0.8
+    # a chunk is sent off for transcription at the first short pause once it is at least chunk_length long
+    pause: float = 0.25
+    chunk_length: float = 4.0
+    max_chunk_length: float = 10.0
+    block_length: float = 0.03
+
+
+class RingBuffer:
+    """A preallocated buffer holding the most recent samples. Positions count every sample ever written, so a
+    range stays addressable until it is overwritten."""
+
+    def __init__(self, capacity: int):
+        self._data = np.zeros(capacity, dtype=np.int16)
+        self.written = 0
+
+    def write(self, samples: np.ndarray):
+        capacity = len(self._data)
+        samples = samples[-capacity:]
+        start = self.written % capacity
+        first = min(len(samples), capacity - start)
+        self._data[start:start + first] = samples[:first]
+        self._data[:len(samples) - first] = samples[first:]
+        self.written += len(samples)
+
+    def read(self, start: int, end: int) -> np.ndarray:
+        capacity = len(self._data)
+        start = max(start, self.written - capacity, 0)
+        indices = np.arange(start, end) % capacity
+        return self._data[indices]
+
+
+def set_stt_provider(provider: SttProvider):
+    """Sets the provider used for every transcription. Call it at startup so the model is loaded before the first
+    utterance."""
+    global _stt_provider
+    _stt_provider = provider
+
+
+def set_stt_worker(worker: "SttWorker | None"):
+    """Captures and transcribes in the worker's process instead of this one, the provider set here isn't used."""
+    global _stt_worker
+    _stt_worker = worker
+
+
+def get_stt_provider() -> SttProvider:
+    global _stt_provider
+    if _stt_provider is None:
+        from stt_providers.whisper_stt_provider import WhisperSttProvider
+        _stt_provider = WhisperSttProvider()
+
+    return _stt_provider
+
+
+def transcribe(samples: np.ndarray) -> str:
+    if len(samples) == 0:
+        return ""
+
+    if _stt_worker is not None:
+        # audio longer than the worker takes at once, such as a long push to talk, is transcribed in pieces
+        pieces = (samples[start:start + _stt_worker.max_samples]
+                  for start in range(0, len(samples), _stt_worker.max_samples))
+        texts = [_stt_worker.transcribe(piece).result() for piece in pieces]
+        return ' '.join(text.strip() for text in texts if text.strip())
+
+    try:
+        return get_stt_provider().transcribe(samples, SAMPLE_RATE)
+    except Exception as e:
+        logger.warning("could not transcribe audio: %r", e)
+        return ""
+
+
+async def _transcribe_in_worker(samples: np.ndarray) -> str:
+    # queuing can wait for room in the worker's ring, which mustn't hold up the event loop
+    future = await asyncio.to_thread(_stt_worker.transcribe, samples)
+    return await asyncio.wrap_future(future)
+
+
+def _transcribe_soon(samples: np.ndarray) -> asyncio.Future:
+    if _stt_worker is not None and len(samples) > 0:
+        return asyncio.ensure_future(_transcribe_in_worker(samples))
+    return asyncio.get_running_loop().run_in_executor(_transcription_executor, transcribe, samples)
+
+
+async def _microphone_blocks(settings: VadSettings) -> AsyncIterator[np.ndarray]:
+    import sounddevice as sd
+
+    loop = asyncio.get_running_loop()
+    blocks: asyncio.Queue[np.ndarray] = asyncio.Queue()
+
+    def callback(indata, frames, time, status):
+        loop.call_soon_threadsafe(blocks.put_nowait, indata[:, 0].copy())
+
+    with sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype='int16',
+                        blocksize=int(settings.block_length * SAMPLE_RATE), callback=callback):
+        print("Listening...")
+        while True:
+            yield await blocks.get()
+
+
+async def stream_stt(settings: VadSettings | None = None,
+                     source: AsyncIterator[np.ndarray] | None = None) -> AsyncIterator[Transcript]:
+    """Listens for one utterance without needing a key press. Speech is detected by its energy, and is transcribed
+    in chunks while the user is still talking, yielding a partial transcript as each chunk is done and a final one
+    once the user stops. The chunk in progress is also transcribed at every pause, so partial transcripts of
+    what has been said so far come even for utterances shorter than a chunk. source gives blocks of mono int16
+    samples to listen to instead of the microphone, such as a recording being replayed, and running out of blocks
+    ends the utterance."""
+    if settings is None:
+        settings = VadSettings()
+
+    ring = RingBuffer(int(SAMPLE_RATE * (settings.max_chunk_length * 2 + settings.pre_roll)))
+    if source is not None:
+        blocks = source
+    elif _stt_worker is not None:
+        blocks = _stt_worker.microphone_blocks(settings)
+    else:
+        blocks = _microphone_blocks(settings)
+
+    def seconds(length: float) -> int:
+        return int(length * SAMPLE_RATE)
+
+    noise_floor = settings.min_threshold / settings.noise_ratio
+    speech_start: int | None = None
+    chunk_start = 0
+    last_voiced = 0
+    end = 0
+    chunks: list[asyncio.Future] = []
+    texts: list[str] = []
+    # the chunk in progress as transcribed at the last pause, with where the chunk started, one at a time
+    preview: tuple[int, asyncio.Future] | None = None
+    previewed_until = 0
+
+    try:
+        async for samples in blocks:
+            ring.write(samples)
+            end = ring.written
+            rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float32))))
+            voiced = rms > max(settings.min_threshold, noise_floor * settings.noise_ratio)
+
+            if not voiced:
+                noise_floor = noise_floor * 0.95 + rms * 0.05
+
+            if speech_start is None:
+                if voiced:
+                    speech_start = max(end - seconds(settings.pre_roll), 0)
+                    chunk_start = speech_start
+                    last_voiced = end
+                continue
+
+            if voiced:
+                last_voiced = end
+
+            silence = end - last_voiced
+            if silence >= seconds(settings.end_silence):
+                break
+
+            length = end - chunk_start
+            if (length >= seconds(settings.chunk_length) and silence >= seconds(settings.pause)) or \
+                    length >= seconds(settings.max_chunk_length):
+                chunks.append(_transcribe_soon(ring.read(chunk_start, end)))
+                chunk_start = end
+            elif silence >= seconds(settings.pause) and last_voiced > previewed_until and preview is None:
+                preview = (chunk_start, _transcribe_soon(ring.read(chunk_start, end)))
+                previewed_until = last_voiced
+
+            while len(texts) < len(chunks) and chunks[len(texts)].done():
+                texts.append(chunks[len(texts)].result())
+                yield Transcript(' '.join(text.strip() for text in texts if text.strip()), False)
+
+            if preview is not None and preview[1].done():
+                previewed_start, previewed = preview
+                preview = None
+                # a preview of a chunk that has since been sent off is superseded by the chunk's own transcript
+                if previewed_start == chunk_start and len(texts) == len(chunks):
+                    parts = texts + [previewed.result()]
+                    yield Transcript(' '.join(text.strip() for text in parts if text.strip()), False)
+    finally:
+        if source is None:
+            # stops the microphone
+            await blocks.aclose()
+
+    # the trailing silence is dropped, apart from a little so the last word isn't cut off
+    chunk_end = min(last_voiced + seconds(settings.pause), end)
+    if speech_start is not None and chunk_end > chunk_start:
+        chunks.append(_transcribe_soon(ring.read(chunk_start, chunk_end)))
+
+    ended_at = time.perf_counter()
+    logger.debug("utterance ended, waiting for %d chunks", len(chunks) - len(texts))
+
+    for chunk in chunks[len(texts):]:
+        texts.append(await chunk)
+
+    yield Transcript(' '.join(text.strip() for text in texts if text.strip()), True, ended_at)
+
+
+async def listen(settings: VadSettings | None = None) -> str:
+    """Waits for the user to say something and returns the final transcript."""
+    async for transcript in stream_stt(settings):
+        if transcript.is_final:
+            return transcript.text
+
 
 async def stt(start_key='f8', end_key='f9'):
     loop = asyncio.get_event_loop()
@@ -12,6 +251,9 @@ async def stt(start_key='f8', end_key='f9'):
 
 
 def blocking_stt_function(start_key, end_key):
+    # imported here so transcribing and replaying recordings work without audio devices or keyboard hooks
+    import keyboard
+    import sounddevice as sd
 
 
     # Wait for the user to press the start key
@@ -20,7 +262,6 @@ def blocking_stt_function(start_key, end_key):
     print(f"Recording started. Press {end_key.upper()} to stop recording.")
 
     # Audio recording parameters
-    samplerate = 16000  # Sample rate required by Whisper
     channels = 1
     dtype = 'int16'
 
@@ -42,7 +283,7 @@ def blocking_stt_function(start_key, end_key):
     threading.Thread(target=check_stop, daemon=True).start()
 
     # Start recording
-    with sd.InputStream(samplerate=samplerate, channels=channels, dtype=dtype, callback=callback):
+    with sd.InputStream(samplerate=SAMPLE_RATE, channels=channels, dtype=dtype, callback=callback):
         while not stop_event.is_set():
             sd.sleep(100)
 
@@ -56,19 +297,4 @@ def blocking_stt_function(start_key, end_key):
     audio_data = np.concatenate(audio_frames, axis=0)
     audio_data = audio_data.flatten()
 
-    # Convert numpy array to audio data
-    audio_data = audio_data.tobytes()
-
-    # Use speech_recognition to transcribe
-    recognizer = sr.Recognizer()
-    audio = sr.AudioData(audio_data, samplerate, 2)  # sample_width=2 bytes (int16)
-
-    try:
-        text = recognizer.recognize_whisper(audio)
-        return text
-    except sr.UnknownValueError:
-        print("Whisper could not understand audio")
-        return ""
-    except sr.RequestError as e:
-        print(f"Could not request results from Whisper service; {e}")
-        return ""
+    return transcribe(audio_data)
@@ -0,0 +1,18 @@
+import abc
+
+import numpy as np
+
+
+class SttProvider(metaclass=abc.ABCMeta):
+    """Turns recorded speech into text. Providers load their model once when they are created, so transcribing
+    doesn't pay for loading it again."""
+
+    @abc.abstractmethod
+    def transcribe(self, samples: np.ndarray, sample_rate: int) -> str:
+        """Transcribes mono int16 samples."""
+        pass
+
+    @staticmethod
+    def to_float32(samples: np.ndarray) -> np.ndarray:
+        """Converts int16 samples to the float32 range of -1 to 1 that whisper models expect."""
+        return samples.astype(np.float32) / 32768.0
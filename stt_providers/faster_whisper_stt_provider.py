@@ -0,0 +1,23 @@
+from abc import ABCMeta
+
+import numpy as np
+from faster_whisper import WhisperModel
+
+from stt_provider import SttProvider
+
+
+class FasterWhisperSttProvider(SttProvider, metaclass=ABCMeta):
+    """Whisper on CTranslate2. With int8 weights on the CPU it transcribes several times faster than the PyTorch
+    implementation, which is enough to keep up with speech in real time."""
+
+    def __init__(self, model_size: str = 'base.en', compute_type: str = 'int8', beam_size: int = 1,
+                 threads: int = 0, language: str | None = 'en'):
+        # threads=0 lets CTranslate2 pick based on the number of cores
+        self.model = WhisperModel(model_size, device='cpu', compute_type=compute_type, cpu_threads=threads)
+        self.beam_size = beam_size
+        self.language = language
+
+    def transcribe(self, samples: np.ndarray, sample_rate: int) -> str:
+        segments, _ = self.model.transcribe(self.to_float32(samples), beam_size=self.beam_size,
+                                            language=self.language)
+        return ''.join(segment.text for segment in segments).strip()
@@ -0,0 +1,25 @@
+from abc import ABCMeta
+
+import numpy as np
+import torch
+import whisper
+
+from stt_provider import SttProvider
+
+
+class WhisperSttProvider(SttProvider, metaclass=ABCMeta):
+    """The reference PyTorch whisper implementation."""
+
+    def __init__(self, model_size: str = 'base', beam_size: int | None = None, threads: int | None = None,
+                 language: str | None = 'en'):
+        if threads is not None:
+            torch.set_num_threads(threads)
+
+        self.model = whisper.load_model(model_size)
+        self.beam_size = beam_size
+        self.language = language
+
+    def transcribe(self, samples: np.ndarray, sample_rate: int) -> str:
+        result = self.model.transcribe(self.to_float32(samples), beam_size=self.beam_size, language=self.language,
+                                       fp16=torch.cuda.is_available())
+        return result['text'].strip()
@@ -0,0 +1,199 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing import Queue
+from typing import AsyncIterator, Callable
+
+import numpy as np
+
+from shared_ring import SharedRingBuffer
+from stt import SAMPLE_RATE, VadSettings, set_stt_provider, transcribe
+from stt_provider import SttProvider
+
+logger = logging.getLogger(__name__)
+
+# how often the event reader checks that the worker is still running
+WORKER_CHECK_INTERVAL = 1.0
+
+
+def stt_worker(create_provider: Callable[[], SttProvider], capture_spec: tuple, transcription_spec: tuple,
+               commands: Queue, events: Queue):
+    """Runs in its own process, so capturing and transcribing don't hold the GIL of the process running the event
+    loop. Captured audio is written to the capture ring and each block is announced with ('block', listen id, start,
+    end). Transcription requests are ('transcribe', request id, start, end) ranges of the transcription ring, and are
+    answered with ('text', request id, text). Runs until it is sent None."""
+    set_stt_provider(create_provider())
+    capture = SharedRingBuffer.attach(capture_spec)
+    transcription = SharedRingBuffer.attach(transcription_spec)
+    stream = None
+    events.put(('ready',))
+
+    for command in iter(commands.get, None):
+        if command[0] == 'listen':
+            import sounddevice as sd
+
+            _, listen_id, block_length = command
+
+            def callback(indata, frames, time, status, listen_id=listen_id):
+                start = capture.written
+                capture.write(indata[:, 0])
+                events.put(('block', listen_id, start, capture.written))
+
+            stream = sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype='int16',
+                                    blocksize=int(block_length * SAMPLE_RATE), callback=callback)
+            stream.start()
+        elif command[0] == 'stop':
+            if stream is not None:
+                stream.close()
+                stream = None
+        elif command[0] == 'transcribe':
+            _, request_id, start, end = command
+            samples = transcription.read(start, end)
+            transcription.consume(end)
+            events.put(('text', request_id, transcribe(samples)))
+
+    if stream is not None:
+        stream.close()
+    capture.close()
+    transcription.close()
+
+
+class SttWorker:
+    """Captures and transcribes speech in a worker process. Audio goes both ways through shared memory rings, only
+    positions and text are sent through queues. Set it with stt.set_stt_worker to have stt, listen and stream_stt
+    use it.
+
+    create_provider is called in the worker to load the model there, so it has to be picklable, such as the provider
+    class or a functools.partial of it."""
+
+    def __init__(self, create_provider: Callable[[], SttProvider], capture_seconds: float = 30.0,
+                 transcription_seconds: float = 60.0):
+        self.capture_ring = SharedRingBuffer(int(capture_seconds * SAMPLE_RATE), np.int16)
+        # chunks wait here until the worker gets to them, so it holds several of the longest ones
+        self.transcription_ring = SharedRingBuffer(int(transcription_seconds * SAMPLE_RATE), np.int16)
+
+        context = multiprocessing.get_context('spawn')
+        self._commands = context.Queue()
+        self._events = context.Queue()
+        self._process = context.Process(target=stt_worker, args=(create_provider, self.capture_ring.spec,
+                                                                 self.transcription_ring.spec, self._commands,
+                                                                 self._events), daemon=True)
+        self._process.start()
+
+        self._ids = itertools.count()
+        self._pending: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        # held while waiting for room in the transcription ring, so that wait doesn't hold up results
+        self._write_lock = threading.Lock()
+        # set once the worker has died, everything waiting on it and everything asked of it afterwards fails with it
+        self._error: Exception | None = None
+        self._closing = False
+        self.ready = threading.Event()
+        # the loop and queue of the microphone_blocks generator that is listening, and its listen id
+        self._listener: tuple[asyncio.AbstractEventLoop, asyncio.Queue, int] | None = None
+        self._reader = threading.Thread(target=self._read_events, daemon=True)
+        self._reader.start()
+
+    @property
+    def max_samples(self) -> int:
+        """The most samples transcribe takes at once, longer audio has to be transcribed in pieces."""
+        return self.transcription_ring.capacity
+
+    def transcribe(self, samples: np.ndarray) -> Future:
+        """Queues samples to be transcribed, safe to call from any thread. Wrap the future with asyncio.wrap_future
+        to await it. Raises ValueError for more than max_samples, and TimeoutError if the worker is so far behind
+        that there is no room for them."""
+        future = Future()
+        if self._error is not None:
+            future.set_exception(self._error)
+            return future
+
+        with self._write_lock:
+            pcm_range = self.transcription_ring.write_range(samples, wait=True)
+            with self._lock:
+                if self._error is not None:
+                    future.set_exception(self._error)
+                    return future
+                request_id = next(self._ids)
+                self._pending[request_id] = future
+            # sent in the order they were written, the worker consumes the ring in that order
+            self._commands.put(('transcribe', request_id, pcm_range.start, pcm_range.end))
+        return future
+
+    def warm_up(self):
+        """Blocks until the worker has loaded its model and transcribed once, the first transcription is slower."""
+        self.transcribe(np.zeros(SAMPLE_RATE // 2, dtype=np.int16)).result()
+
+    async def microphone_blocks(self, settings: VadSettings) -> AsyncIterator[np.ndarray]:
+        """Blocks of microphone samples, captured by the worker for as long as this is iterated."""
+        # None once the worker has died
+        blocks: asyncio.Queue[tuple[int, int] | None] = asyncio.Queue()
+        listen_id = next(self._ids)
+        self._listener = (asyncio.get_running_loop(), blocks, listen_id)
+        if self._error is not None:
+            self._listener = None
+            raise self._error
+        self._commands.put(('listen', listen_id, settings.block_length))
+        logger.info('listening')
+
+        try:
+            while True:
+                block = await blocks.get()
+                if block is None:
+                    raise self._error
+                yield self.capture_ring.read(*block)
+        finally:
+            self._listener = None
+            self._commands.put(('stop',))
+
+    def _read_events(self):
+        while True:
+            try:
+                event = self._events.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                # a worker that failed to load its provider or was killed would otherwise be waited on forever
+                if not self._process.is_alive() and not self._closing:
+                    self._fail(RuntimeError(f'the stt worker exited with code {self._process.exitcode}'))
+                    return
+                continue
+            if event is None:
+                return
+
+            if event[0] == 'ready':
+                self.ready.set()
+            elif event[0] == 'block':
+                _, listen_id, start, end = event
+                listener = self._listener
+                # blocks captured just before the last listener stopped are dropped
+                if listener is not None and listener[2] == listen_id:
+                    listener[0].call_soon_threadsafe(listener[1].put_nowait, (start, end))
+            elif event[0] == 'text':
+                _, request_id, text = event
+                with self._lock:
+                    future = self._pending.pop(request_id)
+                future.set_result(text)
+
+    def _fail(self, error: Exception):
+        with self._lock:
+            self._error = error
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.set_exception(error)
+
+        listener = self._listener
+        if listener is not None:
+            listener[0].call_soon_threadsafe(listener[1].put_nowait, None)
+
+    def close(self):
+        self._closing = True
+        self._commands.put(None)
+        self._process.join()
+        self._events.put(None)
+        self._reader.join()
+        self.capture_ring.close()
+        self.transcription_ring.close()
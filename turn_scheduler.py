@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+from agent import Agent, AgentContext, EnvironmentalContext
+
+logger = logging.getLogger(__name__)
+
+_current_token: ContextVar["CancellationToken | None"] = ContextVar('current_cancellation_token', default=None)
+
+
+class CancellationToken:
+    """Cancelled when the turn it belongs to is pre-empted. Work that outlives the turn's task, like a client running
+    an action or audio that is already queued, registers a callback so it can be stopped too."""
+    cancelled: bool
+    reason: str | None
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+        self._callbacks: list[Callable[[], ...]] = []
+
+    def on_cancel(self, callback: Callable[[], ...]) -> Callable[[], None]:
+        """Calls the callback when the token is cancelled, right away if it already is. Returns a function that
+        unregisters it again."""
+        if self.cancelled:
+            callback()
+            return lambda: None
+
+        self._callbacks.append(callback)
+
+        def remove():
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+        return remove
+
+    def cancel(self, reason: str | None = None):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.reason = reason
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def get_cancellation_token() -> CancellationToken | None:
+    """The token of the turn the caller is running in, or None outside of a turn."""
+    return _current_token.get()
+
+
+class TurnScheduler:
+    """Runs each turn as its own task, with at most one turn running at a time. Starting a turn pre-empts the one
+    before it: its task is cancelled, which cancels its model request, and its token is cancelled, which stops its
+    speech and the actions it is waiting on.
+
+    Urgent environmental context pre-empts the running turn as soon as it is added, and starts urgent_turn if it is
+    set so the agent can react to it."""
+    urgent_turn: Callable[[], Awaitable] | None
+
+    def __init__(self, agent: Agent):
+        self.agent = agent
+        self.urgent_turn = None
+        self._task: asyncio.Task | None = None
+        self._token: CancellationToken | None = None
+
+        agent.context_added_notifiers.append(self._on_context_added)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, turn: Callable[[], Awaitable], reason: str = 'a new turn started') -> asyncio.Task:
+        """Pre-empts the running turn and starts a new one. turn is called inside the new turn's task."""
+        self.preempt(reason)
+
+        token = CancellationToken()
+        token.on_cancel(self.agent.cancel_speech)
+        self._token = token
+        self._task = asyncio.create_task(self._run(turn, token))
+        return self._task
+
+    async def _run(self, turn: Callable[[], Awaitable], token: CancellationToken):
+        _current_token.set(token)
+        try:
+            await turn()
+        except asyncio.CancelledError:
+            if not token.cancelled:
+                raise
+            logger.info('turn was pre-empted: %s', token.reason)
+
+    def preempt(self, reason: str | None = None):
+        """Cancels the running turn, if there is one."""
+        if not self.running:
+            return
+
+        self._token.cancel(reason)
+        self._task.cancel()
+
+    async def wait(self):
+        """Waits until the running turn has finished or been pre-empted."""
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _on_context_added(self, ctx: AgentContext):
+        if type(ctx) is not EnvironmentalContext or not ctx.urgent:
+            return
+
+        if self.urgent_turn is not None:
+            self.start(self.urgent_turn, 'urgent environmental context')
+        else:
+            self.preempt('urgent environmental context')
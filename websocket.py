@@ -1,113 +1,393 @@
 import asyncio
+import itertools
+import logging
 import time
+from collections import OrderedDict
+from typing import Callable
 
 import websockets
 import json
 from uuid import uuid4 as uuid
 
-from websockets import ConnectionClosedError
+from websockets import ConnectionClosed
 from websockets.asyncio.server import ServerConnection
 
-from agent import Agent, Action, EnvironmentalContext
+from agent import Agent, Action, ActionFailure, HumanContext
+from environment_coalescer import EnvironmentCoalescer
+from turn_scheduler import get_cancellation_token
+from websocket_protocol import PROTOCOL_VERSION, CODECS, JSON_CODEC, InvalidMessage, negotiate_codec, decode_frame, \
+    create_deflate_extension, action_hash, registry_hash
 
+logger = logging.getLogger(__name__)
 
-def create_action(websocket_manager: "WebsocketManager", action_name: str, websocket):
+_UNREAD = object()
+_connection_ids = itertools.count()
+
+
+def create_action(websocket_manager: "WebsocketManager", action_name: str,
+                  connection: "ClientConnection | None" = None):
+    """Creates the function of an action run by a client. Without a connection, each call goes to whichever client
+    registered the action and is least busy at the time."""
     async def execute(params: dict[str, ...]):
-        cur_id = str(uuid())
+        target = connection if connection is not None else websocket_manager.route_action(action_name)
+        if target is None or target.closed:
+            return ActionFailure("this action is not available right now, no client that runs it is connected.")
 
-        await websocket.send(json.dumps(
-            {
-                'type': 'execute_action',
-                'action_name': action_name,
-                'action_id': cur_id,
-                'params': json.dumps(params),
-            }
-        ))
-        print(id(asyncio.get_running_loop()))
+        cur_id = str(uuid())
 
+        # registered before sending, so a fast result can't arrive before anyone is waiting for it
         future = asyncio.get_running_loop().create_future()
         websocket_manager.pending_actions[cur_id] = future
+        target.pending_action_ids.add(cur_id)
+
+        cancelled = False
+
+        def cancel():
+            # the client is told to stop, in case the action is still doing something the user no longer wants
+            nonlocal cancelled
+            if cancelled:
+                return
+            cancelled = True
+            if not future.done():
+                future.set_result(ActionFailure('the action was cancelled, the user interrupted.'))
+            asyncio.get_running_loop().create_task(target.send({'type': 'cancel_action', 'action_id': cur_id}))
+
+        token = get_cancellation_token()
+        remove_cancel_callback = token.on_cancel(cancel) if token is not None else None
 
         try:
-            # Await the future with a 10-second timeout
+            await target.send({
+                'type': 'execute_action',
+                'action_name': action_name,
+                'action_id': cur_id,
+                # version 1 clients expect the params encoded a second time
+                'params': params if target.version >= 2 else json.dumps(params),
+            })
+            # Await the future with a 30-second timeout
             response = await asyncio.wait_for(future, timeout=30.0)
         except asyncio.TimeoutError:
             # Handle timeout here if needed
-            print(f"Action {action_name} {cur_id} timed out. ")
-            response = "sorry, the action timed out."  # Or any default response you'd like to return on timeout
+            logger.warning("action %s %s timed out", action_name, cur_id)
+            response = ActionFailure("sorry, the action timed out.")
+        except asyncio.CancelledError:
+            cancel()
+            raise
         finally:
+            if remove_cancel_callback is not None:
+                remove_cancel_callback()
             # Clean up pending actions regardless of timeout
             del websocket_manager.pending_actions[cur_id]
+            target.pending_action_ids.discard(cur_id)
 
         return response
 
     return execute
 
 
+class ClientConnection:
+    """A connected client. Messages to it go through a bounded queue drained by its own writer task, so a slow
+    client only holds up itself. Version 2 clients get whatever has queued up sent as one batch."""
+    websocket: ServerConnection
+    connection_id: int
+    version: int
+    client_id: str | None
+    action_names: set[str]
+    ephemeral_group_ids: set[int]
+    pending_action_ids: set[str]
+
+    def __init__(self, websocket: ServerConnection, max_queued: int = 256, send_timeout: float = 5.0,
+                 max_batch: int = 64):
+        self.websocket = websocket
+        # unlike id(), never reused by a later connection, so it can key state kept for this connection
+        self.connection_id = next(_connection_ids)
+        self.send_timeout = send_timeout
+        self.max_batch = max_batch
+        self.version = 1
+        self.codec = JSON_CODEC
+        # clients that give a stable id get their action definitions cached across reconnects
+        self.client_id = None
+        self.action_names = set()
+        self.ephemeral_group_ids = set()
+        self.pending_action_ids = set()
+        self.closed = False
+        # messages are queued with the codec to send them with, so switching codec doesn't affect queued messages
+        self._send_queue: asyncio.Queue[tuple[dict, object]] = asyncio.Queue(max_queued)
+        self._writer = asyncio.create_task(self._write_messages())
+
+    async def send(self, message: dict, codec=None):
+        """Queues a message. If the queue stays full for send_timeout the client isn't keeping up, and it is
+        disconnected rather than letting its backlog grow."""
+        if self.closed:
+            return
+
+        try:
+            await asyncio.wait_for(self._send_queue.put((message, codec or self.codec)), self.send_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('client %s is not reading its messages, disconnecting it', self.client_id)
+            await self.close()
+
+    async def _write_messages(self):
+        # a message taken off the queue that couldn't join the previous batch because it uses another codec
+        held = None
+
+        try:
+            while True:
+                message, codec = held if held is not None else await self._send_queue.get()
+                held = None
+
+                if self.version >= 2:
+                    batch = [message]
+                    while len(batch) < self.max_batch and not self._send_queue.empty():
+                        next_message, next_codec = self._send_queue.get_nowait()
+                        if next_codec is not codec:
+                            held = (next_message, next_codec)
+                            break
+                        batch.append(next_message)
+                    if len(batch) > 1:
+                        message = {'type': 'batch', 'messages': batch}
+
+                await self.websocket.send(codec.encode(message))
+        except ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.cancel()
+        await self.websocket.close()
+
+
 class WebsocketManager:
-    def __init__(self, agent: Agent):
+    def __init__(self, agent: Agent, heartbeat_interval: float = 10.0, heartbeat_timeout: float = 10.0,
+                 legacy_handshake_timeout: float = 0.5, max_cached_clients: int = 256):
         self.agent = agent
-        self.connections = set()
+        # clients that don't say hello within this long are asked for all of their actions the old way
+        self.legacy_handshake_timeout = legacy_handshake_timeout
+        self.max_cached_clients = max_cached_clients
+        # client id -> action name -> (definition hash, registration data), kept after the client disconnects
+        self.schema_cache: OrderedDict[str, dict[str, tuple[str, dict]]] = OrderedDict()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.connections: set[ClientConnection] = set()
+        # action name -> every connection that has registered it
+        self.action_routes: dict[str, list[ClientConnection]] = {}
         self.pending_actions: dict[str, asyncio.Future] = {}
         self.requests_action = asyncio.Event()
+        # set once init_websocket is accepting connections
+        self.listening = asyncio.Event()
+        self.environment_coalescer = EnvironmentCoalescer(agent)
+        # called with the connection and the context when a client says something as the user
+        self.human_context_notifiers: list[Callable[[ClientConnection, HumanContext], ...]] = []
+
+    def route_action(self, name: str) -> ClientConnection | None:
+        """Picks the connection with the fewest actions in flight out of those that registered the action."""
+        routes = self.action_routes.get(name)
+        if not routes:
+            return None
+
+        # rotating the list spreads calls evenly between connections that are equally busy
+        routes.append(routes.pop(0))
+        return min(routes, key=lambda connection: len(connection.pending_action_ids))
+
+    async def read_first_frame(self, websocket: ServerConnection) -> str | bytes | None:
+        """Waits for the client's hello. Older clients never send one and wait to be asked for their actions, for
+        them this returns None."""
+        try:
+            return await asyncio.wait_for(websocket.recv(), self.legacy_handshake_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def manage(self, websocket: ServerConnection, first_frame=_UNREAD):
+        """Serves a connection until it closes. first_frame is given when the caller already read it, such as to
+        pick which session the connection belongs to."""
+        client = ClientConnection(websocket)
+        self.connections.add(client)
 
-    async def manage(self, websocket: ServerConnection):
-        self.connections.add(websocket)
-        print('send_all_actions requested')
-        await asyncio.sleep(2)
-        await websocket.send(json.dumps({'type': 'send_all_actions'}))
-
-        while True:
-            try:
-                str_data = await websocket.recv()
-                print('received: ', str_data)
-                data = json.loads(str_data)
-
-                path = data.get('path')
-
-                if path == 'actions/register':
-                    self.agent.action_manager.register_action(self.generate_action_using_data(data, websocket))
-                elif path == 'actions/register/ephemeral':
-                    actions = []
-                    for action in data['actions']:
-                        actions.append(self.generate_action_using_data(action, websocket))
-                    self.agent.action_manager.create_ephemeral_action_group(actions)
-                elif path == 'action/result':
-                    action = self.pending_actions.get(data['action_id'])
-
-                    if action is None:
-                        await websocket.send(json.dumps({'ok': False, 'message': 'action_id does not exist'}))
-                        continue
-
-                    action.set_result(data['result'])
-                    action.done()
-                elif path == 'context/environment':
-                    self.agent.add_context(EnvironmentalContext(data['value']))
-                elif path == 'actions/request':
-                    self.requests_action.set()
-                elif path == 'actions/force':
-                    self.agent.action_manager.enqueue_forced_action(data['name'])
-                else:
-                    await websocket.send(json.dumps({'ok': False, 'message': 'unknown message type'}))
-            except json.JSONDecodeError:
-                await websocket.send(json.dumps({"ok": False, "message": "Invalid JSON"}))
-            except ConnectionClosedError:
-                break
-
-    def generate_action_using_data(self, data, websocket):
+        try:
+            if first_frame is _UNREAD:
+                first_frame = await self.read_first_frame(websocket)
+
+            first = await self.receive(client, first_frame) if first_frame is not None else None
+            if first is None or first.get('path') != 'hello':
+                logger.debug('client sent no hello, requesting all of its actions')
+                await client.send({'type': 'send_all_actions'})
+
+            while True:
+                await self.receive(client, await websocket.recv())
+        except ConnectionClosed:
+            pass
+        finally:
+            self.disconnect(client)
+
+    async def receive(self, client: ClientConnection, frame: str | bytes) -> dict | None:
+        """Decodes and handles one frame, returning the message or None if it couldn't be decoded."""
+        logger.debug('received: %r', frame)
+        try:
+            data = decode_frame(frame)
+        except InvalidMessage:
+            await client.send({"ok": False, "message": "Invalid JSON"})
+            return None
+
+        await self.handle_message(client, data)
+        return data
+
+    async def handle_message(self, client: ClientConnection, data: dict):
+        path = data.get('path')
+
+        if path == 'hello':
+            client.version = min(data.get('version', 1), PROTOCOL_VERSION)
+            codec = negotiate_codec(data.get('encodings', []))
+            # the reply still goes out in the old encoding, the client can't decode the new one until it has it
+            await client.send({'type': 'hello', 'version': client.version, 'encoding': codec.name,
+                               'encodings': list(CODECS)}, client.codec)
+            client.codec = codec
+            await self.restore_registry(client, data)
+        elif path == 'batch':
+            for message in data['messages']:
+                await self.handle_message(client, message)
+        elif path == 'actions/register':
+            # a batch of actions can be registered at once by sending them as a list
+            for action in data.get('actions', [data]):
+                self.register_action(client, action)
+        elif path == 'actions/register/ephemeral':
+            actions = []
+            for action in data['actions']:
+                actions.append(self.generate_action_using_data(action, client))
+            group_id = self.agent.action_manager.create_ephemeral_action_group(actions)
+            client.ephemeral_group_ids.add(group_id)
+        elif path == 'action/result':
+            # results can be batched by sending them as a list
+            for result in data.get('results', [data]):
+                action = self.pending_actions.get(result['action_id'])
+
+                if action is None:
+                    await client.send({'ok': False, 'message': 'action_id does not exist',
+                                       'action_id': result['action_id']})
+                    continue
+
+                # a call that was cancelled or whose client disconnected is already answered, late results are dropped
+                if not action.done():
+                    action.set_result(result['result'])
+        elif path == 'context/environment':
+            # updates are coalesced per source, sources are only shared within a connection
+            source = data.get('source')
+            # urgent updates skip the coalescing and pre-empt the running turn
+            self.environment_coalescer.submit(f'{client.connection_id}:{source}', data['value'], source,
+                                              data.get('urgent', False))
+        elif path == 'context/human':
+            human_context = HumanContext(data['text'])
+            self.agent.add_context(human_context)
+            for notifier in self.human_context_notifiers:
+                notifier(client, human_context)
+        elif path == 'actions/request':
+            self.requests_action.set()
+        elif path == 'actions/force':
+            self.agent.action_manager.enqueue_forced_action(data['name'])
+        else:
+            await client.send({'ok': False, 'message': 'unknown message type'})
+
+    async def restore_registry(self, client: ClientConnection, hello: dict):
+        """Registers the actions cached from a client's previous connection that are still current, then asks for
+        only the ones that aren't. Clients send action_hashes, a name -> action_hash map of their registry, or just
+        registry_hash if they expect nothing to have changed."""
+        client.client_id = hello.get('client_id')
+        cached = self.schema_cache.get(client.client_id) if client.client_id is not None else None
+        if cached is None:
+            await client.send({'type': 'send_all_actions'})
+            return
+        self.schema_cache.move_to_end(client.client_id)
+
+        cached_hashes = {name: definition_hash for name, (definition_hash, _) in cached.items()}
+        client_hashes = hello.get('action_hashes')
+        if client_hashes is None:
+            if hello.get('registry_hash') != registry_hash(cached_hashes):
+                await client.send({'type': 'send_all_actions'})
+                return
+            client_hashes = cached_hashes
+
+        for name in list(cached):
+            if name not in client_hashes:
+                del cached[name]
+
+        restored = [name for name, definition_hash in client_hashes.items() if cached_hashes.get(name) ==
+                    definition_hash]
+        needed = [name for name in client_hashes if name not in restored]
+
+        for name in restored:
+            self.register_action(client, cached[name][1])
+
+        await client.send({'type': 'send_actions', 'names': needed, 'restored': restored})
+
+    def register_action(self, client: ClientConnection, data: dict):
+        name = data['name']
+
+        if client.client_id is not None:
+            cache = self.schema_cache.setdefault(client.client_id, {})
+            cache[name] = (action_hash(data), data)
+            self.schema_cache.move_to_end(client.client_id)
+            while len(self.schema_cache) > self.max_cached_clients:
+                self.schema_cache.popitem(last=False)
+
+        routes = self.action_routes.setdefault(name, [])
+        if client not in routes:
+            routes.append(client)
+        client.action_names.add(name)
+
+        # registering again replaces the description and schema, calls are routed by name either way
+        self.agent.action_manager.register_action(self.generate_action_using_data(data))
+
+    def disconnect(self, client: ClientConnection):
+        """Forgets a connection. Its actions are unregistered unless another client also runs them, and any calls
+        waiting on it are answered straight away instead of timing out."""
+        client.closed = True
+        # the writer would otherwise wait on the send queue forever, keeping the client and its backlog alive
+        client._writer.cancel()
+        self.connections.discard(client)
+        self.environment_coalescer.forget(f'{client.connection_id}:')
+
+        for name in client.action_names:
+            routes = self.action_routes.get(name, [])
+            if client in routes:
+                routes.remove(client)
+            if len(routes) == 0:
+                self.action_routes.pop(name, None)
+                if name in self.agent.action_manager.actions:
+                    self.agent.action_manager.unregister_action(name)
+
+        for group_id in client.ephemeral_group_ids:
+            self.agent.action_manager.remove_ephemeral_action_group(group_id)
+
+        for action_id in client.pending_action_ids:
+            future = self.pending_actions.get(action_id)
+            if future is not None and not future.done():
+                future.set_result(ActionFailure('the client running this action disconnected before it finished.'))
+
+        logger.info('client disconnected, %d still connected', len(self.connections))
+
+    async def broadcast(self, message: dict):
+        """Sends a message to every connected client."""
+        await asyncio.gather(*[client.send(message) for client in list(self.connections)])
+
+    def generate_action_using_data(self, data, connection: ClientConnection | None = None):
         return Action(
             data['name'],
             data['description'],
             data['schema'],
-            create_action(self, data['name'], websocket)
+            create_action(self, data['name'], connection),
+            data.get('max_concurrency'),
+            data.get('timeout'),
+            data.get('idempotent', False)
         )
 
-
-
-
-    async def init_websocket(self):
+    async def init_websocket(self, host: str = "127.0.0.1", port: int = 9302):
         async def man(websocket):
             await self.manage(websocket)
 
-        async with websockets.serve(man, "127.0.0.1", 9302):
+        # the ping/pong heartbeat closes connections to clients that stopped responding, which then clears up
+        # their actions
+        async with websockets.serve(man, host, port, ping_interval=self.heartbeat_interval,
+                                    ping_timeout=self.heartbeat_timeout, compression=None,
+                                    extensions=[create_deflate_extension()]):
+            self.listening.set()
             await asyncio.Future()
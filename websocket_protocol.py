@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import json
+
+import numpy as np
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# version 1 is the original protocol, version 2 adds encodings, batches and params sent as objects. Clients that
+# never say hello are treated as version 1.
+PROTOCOL_VERSION = 2
+
+
+# the fields of an action registration that make up its definition, and so its hash
+ACTION_DEFINITION_FIELDS = ('name', 'description', 'schema', 'max_concurrency', 'timeout', 'idempotent')
+
+
+def encode_pcm(wav) -> str:
+    """Encodes a float waveform as base64 of 16 bit little-endian PCM, which both codecs can carry."""
+    samples = (np.clip(np.asarray(wav, dtype=np.float32), -1.0, 1.0) * 32767).astype('<i2')
+    return base64.b64encode(samples.tobytes()).decode()
+
+
+def action_hash(data: dict) -> str:
+    """Hashes an action's definition. Clients compute the same hash over the same fields, as sorted compact JSON,
+    to tell the server which of its cached definitions are still current."""
+    definition = {field: data.get(field) for field in ACTION_DEFINITION_FIELDS}
+    return hashlib.sha256(json.dumps(definition, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def registry_hash(action_hashes: dict[str, str]) -> str:
+    """Hashes a whole registry from the hashes of its actions."""
+    lines = '\n'.join(f'{name}:{action_hashes[name]}' for name in sorted(action_hashes))
+    return hashlib.sha256(lines.encode()).hexdigest()
+
+
+class InvalidMessage(Exception):
+    pass
+
+
+class JsonCodec:
+    """Text frames of JSON, using orjson when it is installed."""
+    name = 'json'
+
+    def encode(self, message) -> str:
+        if orjson is not None:
+            return orjson.dumps(message).decode()
+        return json.dumps(message)
+
+    def decode(self, frame: str | bytes):
+        try:
+            if orjson is not None:
+                return orjson.loads(frame)
+            return json.loads(frame)
+        except ValueError as error:
+            raise InvalidMessage(str(error))
+
+
+class MsgpackCodec:
+    """Binary frames of msgpack, which are smaller and quicker to parse than JSON."""
+    name = 'msgpack'
+
+    def encode(self, message) -> bytes:
+        return msgpack.packb(message)
+
+    def decode(self, frame: str | bytes):
+        try:
+            return msgpack.unpackb(frame)
+        except (ValueError, msgpack.ExtraData) as error:
+            raise InvalidMessage(str(error))
+
+
+JSON_CODEC = JsonCodec()
+CODECS = {JSON_CODEC.name: JSON_CODEC}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def negotiate_codec(requested: list[str]) -> JsonCodec | MsgpackCodec:
+    """Picks the first encoding the client asked for that the server supports, falling back to JSON."""
+    for name in requested:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+def decode_frame(frame: str | bytes):
+    """Decodes a frame by its type, text frames are always JSON and binary frames are always msgpack. This way a
+    client can be sent one encoding while still sending the other."""
+    if isinstance(frame, str):
+        return JSON_CODEC.decode(frame)
+    if msgpack is None:
+        raise InvalidMessage('binary frames are not supported, msgpack is not installed')
+    return CODECS[MsgpackCodec.name].decode(frame)
+
+
+def create_deflate_extension() -> ServerPerMessageDeflateFactory:
+    """permessage-deflate with smaller windows and less memory than the defaults. Messages are small and similar,
+    so this keeps nearly all of the compression at a fraction of the memory per connection."""
+    return ServerPerMessageDeflateFactory(
+        server_max_window_bits=11,
+        client_max_window_bits=11,
+        compress_settings={'memLevel': 4},
+    )